@@ -1,7 +1,6 @@
 import numpy as np
-import scipy.io 
-import pandas as pd
 from itertools import combinations
+from scipy.linalg import cho_factor, cho_solve
 import process_data as prd
 
 # train and predict for data: (samples,feat), label: (samples, 1)
@@ -23,89 +22,147 @@ def eval_lda_ch(mu_class, C, n_type, x, y):
     elif full_type == 'part':
         start_ch = num_ch - 1
 
+    # features of all channels once, each channel subset is a column selection of them
+    n_ch = x.shape[1]
+    feat = prd.extract_feats_par(x)
     acc = np.zeros(num_ch-start_ch)
     # loop through channel noise
     for num_noise in range(start_ch,num_ch):
         ch_all = list(combinations(range(0,6),num_noise))
         ch_split = x.shape[0]//len(ch_all)
-        acc_ch = np.zeros(len(ch_all))
-        for ch in range(0,len(ch_all)):
-            temp = x[ch*ch_split:(ch+1)*ch_split,...]
-            y_test = y[ch*ch_split:(ch+1)*ch_split,...]
-            mask = np.ones(temp.shape[1],dtype=bool)
-            for i in ch_all[ch]:
-                mask[i] = 0
-            maskmu = np.tile(mask,4)
-            test_data = prd.extract_feats(temp[:,mask,:])
-            C_temp = C[maskmu,:]
-            C_in = C_temp[:,maskmu]
-            w_temp, c_temp = train_lda(test_data,y_test,mu_bool = True, mu_class = mu_class[:,maskmu], C = C_in)
-            acc_ch[ch] = eval_lda(w_temp, c_temp, test_data, y_test)
+        keep = ch_columns([[i for i in range(n_ch) if i not in chs] for chs in ch_all], n_ch)
+
+        # block ch of ch_split rows is tested with channels ch_all[ch] removed, all blocks at once
+        n_sub = len(ch_all)
+        test_data = np.take_along_axis(feat[:n_sub*ch_split].reshape(n_sub, ch_split, -1), keep[:,np.newaxis,:], axis=2)
+        y_test = y[:n_sub*ch_split].reshape(n_sub, ch_split)
+
+        # as train_lda with given class means: the first n_class means, n_class counted in each block
+        n_class = np.array([np.unique(y_b).shape[0] for y_b in y_test])
+        w, c = subset_lda(mu_class, C, keep, 1/n_class)
+        f = np.matmul(test_data, np.swapaxes(w, 1, 2)) + np.swapaxes(c, 1, 2)
+        f[np.broadcast_to(np.arange(w.shape[1]) >= n_class[:,np.newaxis,np.newaxis], f.shape)] = -np.inf
+        acc_ch = np.mean(np.argmax(f, axis=2) == y_test, axis=1)
         acc[num_noise-start_ch] = np.mean(acc_ch)
     return acc
 
-# train LDA classifier for data: (samples,feat), label: (samples, 1)
-def train_lda(data,label,mu_bool = False, mu_class = 0, C = 0):
-    m = data.shape[1]
-    u_class = np.unique(label)
+def eval_lda_mask(mu_class, C, feat, y, ch_bits, n_ch=6):
+    # accuracy per channel mask, restricting the LDA to the kept channels' feature columns
+    bits_all = np.unique(ch_bits)
+    acc = np.zeros(bits_all.shape[0])
+    masks = np.array([prd.ch_bits_mask(bits, n_ch) for bits in bits_all]).reshape(-1, n_ch)
+    # masks keeping the same number of channels share one batched downdate of the full inverse
+    for n_kept in np.unique(np.sum(masks, axis=1)):
+        ks = np.nonzero(np.sum(masks, axis=1) == n_kept)[0]
+        keep = ch_columns([np.nonzero(masks[k])[0] for k in ks], n_ch)
+        n_class = np.array([np.unique(y[ch_bits == bits_all[k],...]).shape[0] for k in ks])
+        w, c = subset_lda(mu_class, C, keep, 1/n_class)
+        for i, k in enumerate(ks):
+            rows = ch_bits == bits_all[k]
+            acc[k] = eval_lda(w[i,:n_class[i]], c[i,:n_class[i]], feat[rows,:][:,keep[i]], y[rows,...])
+    return bits_all, acc
+
+def class_stats(data, label):
+    # class labels, class means and the pooled covariance (mean of the per-class np.cov) in one pass
+    u_class, idx = np.unique(label, return_inverse=True)
+    idx = idx.ravel()
     n_class = u_class.shape[0]
+    count = np.bincount(idx, minlength=n_class)
 
-    if not mu_bool:
-        mu = np.mean(data,axis=0,keepdims = True)
-        C = np.zeros([m,m])
-        mu_class = np.zeros([n_class,m])
-        Sb = np.zeros([mu.shape[1],mu.shape[1]])
+    one_hot = (idx == np.arange(n_class)[:,np.newaxis]).astype(data.dtype)
+    mu_class = np.dot(one_hot, data) / count[:,np.newaxis].astype(data.dtype)
 
-        for i in range(0,n_class):
-            ind = label == u_class[i]
-            mu_class[i,:] = np.mean(data[ind[:,0],:],axis=0,keepdims=True)
-            C += np.cov(data[ind[:,0],:].T)
-            Sb += ind.shape[0] * np.dot((mu_class[np.newaxis,i,:] - mu).T,(mu_class[np.newaxis,i,:] - mu))    
+    # class-centred data weighted by 1/(n_i - 1) gives every class's unbiased covariance in one product
+    centred = data - mu_class[idx]
+    scale = (1 / ((count - 1) * n_class)).astype(data.dtype)
+    C = np.dot((centred * scale[idx,np.newaxis]).T, centred)
+    return u_class, mu_class, C
 
-        C /= n_class
+def lda_factor(C, rcond=1e-15):
+    # float64 Cholesky factor of the covariance, None when C is singular or its pivots span more than 1/rcond
+    try:
+        factor = cho_factor(np.asarray(C, dtype=np.float64), lower=True, check_finite=False)
+    except np.linalg.LinAlgError:
+        return None
+    pivots = np.diag(factor[0])**2
+    if pivots.min() > rcond * pivots.max():
+        return factor
+    return None
 
-    prior = 1/n_class
+def lda_solve(C, b, rcond=1e-15):
+    # C^-1 b for all columns of b from one Cholesky factorisation of the covariance, pinv (as before)
+    # when C is near singular
+    factor = lda_factor(C, rcond)
+    if factor is None:
+        return np.dot(np.linalg.pinv(np.asarray(C, dtype=np.float64)), b)
+    return cho_solve(factor, b, check_finite=False)
 
-    w = np.zeros([n_class, m])
-    c = np.zeros([n_class, 1])
+def subset_inv(C, keep, rcond=1e-15):
+    # inverses of C[keep[i]][:,keep[i]] for a stack keep (n_subsets, s) of equal size column subsets, as
+    # block-inverse (Schur complement) downdates of the one full inverse: inv(C_kk) = P_kk - P_kd inv(P_dd) P_dk.
+    # Batched pinv of the sub-covariances when C is near singular
+    C = np.asarray(C, dtype=np.float64)
+    keep = np.asarray(keep)
+    factor = lda_factor(C, rcond)
+    if factor is None:
+        return np.linalg.pinv(C[keep[:,:,np.newaxis], keep[:,np.newaxis,:]])
 
-    for i in range(0, n_class):
-        w[i,:] = np.dot(mu_class[np.newaxis,i,:],np.linalg.pinv(C))
-        c[i,:] = np.dot(-.5 * np.dot(mu_class[np.newaxis,i,:], np.linalg.pinv(C)),mu_class[np.newaxis,i,:].T) + np.log(prior)
+    P = cho_solve(factor, np.eye(C.shape[0]), check_finite=False)
+    P_kk = P[keep[:,:,np.newaxis], keep[:,np.newaxis,:]]
+    if keep.shape[1] == C.shape[0]:
+        return P_kk
+    dropped = np.ones((keep.shape[0], C.shape[0]), dtype=bool)
+    dropped[np.arange(keep.shape[0])[:,np.newaxis], keep] = False
+    drop = np.nonzero(dropped)[1].reshape(keep.shape[0], -1)
+    P_kd = P[keep[:,:,np.newaxis], drop[:,np.newaxis,:]]
+    P_dd = P[drop[:,:,np.newaxis], drop[:,np.newaxis,:]]
+    return P_kk - np.matmul(P_kd, np.linalg.solve(P_dd, np.swapaxes(P_kd, 1, 2)))
 
-    if not mu_bool:
-        return w, c, mu_class, C
-    else:
-        return w, c
+def subset_lda(mu_class, C, keep, prior):
+    # LDA weights (n_subsets, n_class, s) and biases (n_subsets, n_class, 1) restricted to each column subset
+    # in keep, all from one factorisation of the full covariance. prior is a scalar or one per subset
+    inv = subset_inv(C, keep)
+    mu = np.moveaxis(np.asarray(mu_class, dtype=np.float64)[:,keep], 0, 1)
+    w = np.matmul(mu, inv)
+    c = -.5 * np.sum(w * mu, axis=2, keepdims=True) + np.log(np.asarray(prior, dtype=np.float64)).reshape(-1,1,1)
+    return w.astype(prd.DTYPE), c.astype(prd.DTYPE)
 
-# train LDA classifier for data: (feat, samples)
-def train_lda2(data,label):
-    m = data.shape[0]
-    u_class = np.unique(label)
-    n_class = u_class.shape[0]
+def ch_columns(keep_ch, n_ch=6):
+    # flat feature columns [mav, zc, ssc, wl] of the kept channels, keep_ch: (n_subsets, n_kept)
+    keep_ch = np.asarray(keep_ch, dtype=np.intp)
+    return (n_ch*np.arange(4)[:,np.newaxis] + keep_ch[:,np.newaxis,:]).reshape(keep_ch.shape[0], -1)
 
-    mu = np.mean(data,axis=1,keepdims = True)
-    C = np.zeros([m,m])
-    mu_class = np.zeros([m,n_class])
-    Sb = np.zeros([mu.shape[0],mu.shape[0]])
+def lda_coef(mu_class, C, prior):
+    # weights (n_class, feat) and biases (n_class, 1) of every class from one multi right-hand side solve
+    w = lda_solve(C, mu_class.T.astype(np.float64)).T
+    c = -.5 * np.sum(w * mu_class, axis=1, keepdims=True) + np.log(prior)
+    return w.astype(prd.DTYPE), c.astype(prd.DTYPE)
 
-    for i in range(0,n_class):
-        ind = label == u_class[i]
-        mu_class[:,i,np.newaxis] = np.mean(data[:,ind[0,:]],axis=1,keepdims=True)
-        Sb += ind.shape[1] * np.dot((mu_class[:,i,np.newaxis] - mu).T,(mu_class[:,i,np.newaxis] - mu))
-        C += np.cov(data[:,ind[0,:]])
+# train LDA classifier for data: (samples,feat), label: (samples, 1)
+def train_lda(data,label,mu_bool = False, mu_class = 0, C = 0):
+    # computed in the pipeline dtype, prd.DTYPE
+    data = np.asarray(data, dtype=prd.DTYPE)
+    if not mu_bool:
+        u_class, mu_class, C = class_stats(data, label)
+        n_class = u_class.shape[0]
+    else:
+        n_class = np.unique(label).shape[0]
 
-    C /= n_class
+    # with given class means, the first n_class of them are used as before
     prior = 1/n_class
+    w, c = lda_coef(mu_class[:n_class,:], C, prior)
 
-    w = np.zeros([m,n_class])
-    c = np.zeros([1,n_class])
-
-    for i in range(0, n_class):
-        w[:,i,np.newaxis] = np.dot(np.linalg.pinv(C),mu_class[:,i,np.newaxis])
-        c[:,i,np.newaxis] = np.dot(mu_class[:,i,np.newaxis].T,-.5 * np.dot(np.linalg.pinv(C), mu_class[:,i,np.newaxis])) + np.log(prior)
+    if not mu_bool:
+        return w, c, mu_class, C
+    else:
+        return w, c
 
-    return w,c.T
+# train LDA classifier for data: (feat, samples)
+def train_lda2(data,label):
+    data = np.asarray(data, dtype=prd.DTYPE)
+    u_class, mu_class, C = class_stats(data.T, label.T)
+    w, c = lda_coef(mu_class, C, 1/u_class.shape[0])
+    return w.T, c
 
 def predict(data,w,c):
     f = np.dot(w,data.T) + c
@@ -115,4 +172,281 @@ def predict(data,w,c):
 def predict2(data,w,c):
     f = np.dot(w.T,data) + c
     out = np.argmax(f, axis=0)
-    return out
\ No newline at end of file
+    return out
+
+def pad_lda(data, label):
+    # stack problems with different sample counts: data (n_problems, n_max, feat) zero padded and
+    # label (n_problems, n_max) with -1 marking padding rows
+    n_max = max(d.shape[0] for d in data)
+    data_out = np.zeros((len(data), n_max, data[0].shape[1]), dtype=prd.DTYPE)
+    label_out = np.full((len(data), n_max), -1, dtype=np.int64)
+    for i, (d, y) in enumerate(zip(data, label)):
+        data_out[i,:d.shape[0]] = d
+        label_out[i,:d.shape[0]] = np.asarray(y).reshape(-1)
+    return data_out, prd.compact_int(label_out)
+
+def batch_solve(C, b, rcond=1e-15):
+    # C[i]^-1 b[i] for a stack of covariances in float64, pinv for the ones that are near singular
+    C = np.asarray(C, dtype=np.float64)
+    try:
+        pivots = np.diagonal(np.linalg.cholesky(C), axis1=-2, axis2=-1)**2
+        good = pivots.min(axis=-1) > rcond * pivots.max(axis=-1)
+    except np.linalg.LinAlgError:
+        good = np.array([lda_factor(C_i, rcond) is not None for C_i in C], dtype=bool)
+    out = np.empty(b.shape, dtype=np.float64)
+    if np.any(good):
+        out[good] = np.linalg.solve(C[good], b[good])
+    if not np.all(good):
+        out[~good] = np.matmul(np.linalg.pinv(C[~good]), b[~good])
+    return out
+
+def batch_labels(label, shape):
+    # (n_problems, samples) labels from per problem labels or one (samples, 1) column shared by all problems
+    label = np.asarray(label)
+    if label.ndim > 1 and label.shape[-1] == 1:
+        label = label[...,0]
+    return np.broadcast_to(label, shape)
+
+# train LDA classifiers for a stack of problems, data: (n_problems, samples, feat),
+# label: (n_problems, samples) or one (samples, 1) shared by all problems, -1 for padding rows
+def train_lda_batch(data, label, n_class=None):
+    data = np.asarray(data, dtype=prd.DTYPE)
+    label = batch_labels(label, data.shape[:2])
+    if n_class is None:
+        n_class = int(np.max(label)) + 1
+
+    # per problem class counts and means, classes missing from a problem get no score
+    one_hot = (label[...,np.newaxis] == np.arange(n_class)).astype(data.dtype)
+    count = np.sum(one_hot, axis=1, dtype=np.int64)
+    present = count > 0
+    mu_class = np.matmul(np.swapaxes(one_hot, 1, 2), data) / np.maximum(count, 1)[...,np.newaxis].astype(data.dtype)
+
+    # pooled covariance as in class_stats, the mean of the present classes' unbiased covariances
+    n_present = np.sum(present, axis=1, keepdims=True)
+    scale = np.where(present, 1 / (np.maximum(count - 1, 1) * n_present), 0).astype(data.dtype)
+    centred = data - np.matmul(one_hot, mu_class)
+    C = np.matmul(np.swapaxes(centred * np.matmul(one_hot, scale[...,np.newaxis]), 1, 2), centred)
+
+    w = np.swapaxes(batch_solve(C, np.swapaxes(mu_class, 1, 2)), 1, 2)
+    c = -.5 * np.sum(w * mu_class, axis=2) + np.log(1 / n_present)
+    c[~present] = -np.inf
+    return w.astype(prd.DTYPE), c[...,np.newaxis].astype(prd.DTYPE), mu_class, C
+
+def predict_lda_batch(data, w, c):
+    # scores every problem's test set against its own model in one call, (n_problems, samples)
+    f = np.matmul(data, np.swapaxes(w, 1, 2)) + np.swapaxes(c, 1, 2)
+    return np.argmax(f, axis=2)
+
+def eval_lda_batch(w, c, x_test, y_test):
+    # accuracy per problem, padding rows (label -1) are not counted
+    y_test = batch_labels(y_test, np.shape(x_test)[:2])
+    out = predict_lda_batch(x_test, w, c)
+    valid = y_test >= 0
+    return np.sum((out == y_test) & valid, axis=1) / np.sum(valid, axis=1)
+
+def chol_update(L, x, sign=1):
+    # in place rank-one update (sign 1) or downdate (sign -1) of a lower Cholesky factor, L L^T + sign x x^T,
+    # LinAlgError when a downdate would leave the matrix not positive definite
+    x = np.array(x, dtype=np.float64)
+    for k in range(L.shape[0]):
+        r2 = L[k,k]**2 + sign * x[k]**2
+        if not r2 > 0:
+            raise np.linalg.LinAlgError('downdate is not positive definite')
+        r = np.sqrt(r2)
+        cos, sin = r / L[k,k], x[k] / L[k,k]
+        L[k,k] = r
+        L[k+1:,k] = (L[k+1:,k] + sign * sin * x[k+1:]) / cos
+        x[k+1:] = cos * x[k+1:] - sin * L[k+1:,k]
+    return L
+
+class OnlineLDA:
+    # LDA recalibrated as labelled windows arrive: per class counts, means and scatter merged with Chan/Welford
+    # updates, and the Cholesky factor of the pooled within-class scatter S_w kept current with rank-one
+    # updates and downdates. The covariance is the pooled S_w/(N-n_class), equal to train_lda's mean of the
+    # class covariances when the classes are balanced. Rank-one steps run in python, so past max_rank of
+    # them in one call the factor is recomputed from S_w instead
+    def __init__(self, n_feat, n_class=0, rcond=1e-15, max_rank=8):
+        self.n_feat = n_feat
+        self.rcond = rcond
+        self.max_rank = max_rank
+        self.count = np.zeros(n_class, dtype=np.int64)
+        self.mu_class = np.zeros((n_class, n_feat))
+        self.scatter = np.zeros((n_class, n_feat, n_feat))
+        self.S_w = np.zeros((n_feat, n_feat))
+        self.L = None
+        self.coef_cache = None
+
+    @property
+    def n_class(self):
+        return self.count.shape[0]
+
+    def grow(self, n_class):
+        if n_class > self.n_class:
+            extra = n_class - self.n_class
+            self.count = np.concatenate((self.count, np.zeros(extra, dtype=np.int64)))
+            self.mu_class = np.concatenate((self.mu_class, np.zeros((extra, self.n_feat))))
+            self.scatter = np.concatenate((self.scatter, np.zeros((extra, self.n_feat, self.n_feat))))
+
+    def rank_update(self, vecs, sign):
+        # S_w += sign * sum of v v^T, carried into the cached factor while it stays positive definite,
+        # otherwise left to factor()
+        self.S_w += sign * np.dot(vecs.T, vecs)
+        self.coef_cache = None
+        vecs = vecs[np.any(vecs != 0, axis=1)]
+        if vecs.shape[0] > self.max_rank:
+            self.L = None
+        if self.L is not None:
+            try:
+                for v in vecs:
+                    chol_update(self.L, v, sign)
+            except np.linalg.LinAlgError:
+                self.L = None
+
+    def merge(self, k, data, sign):
+        # Chan et al. merge (sign 1) or removal (sign -1) of a block of class k samples, returns the
+        # vectors whose outer products change S_w
+        n, m = self.count[k], data.shape[0]
+        mu_b = np.mean(data, axis=0)
+        centred = data - mu_b
+        n_new = n + sign * m
+        if n_new == 0:
+            shift = np.zeros((0, self.n_feat))
+            mu_new = np.zeros(self.n_feat)
+        elif sign > 0:
+            mu_new = self.mu_class[k] + (mu_b - self.mu_class[k]) * m / n_new
+            shift = (np.sqrt(n * m / n_new) * (mu_b - self.mu_class[k]))[np.newaxis,:]
+        else:
+            mu_new = (n * self.mu_class[k] - m * mu_b) / n_new
+            shift = (np.sqrt(n_new * m / n) * (mu_b - mu_new))[np.newaxis,:]
+        vecs = np.concatenate((centred, shift))
+        self.scatter[k] += sign * np.dot(vecs.T, vecs)
+        self.count[k], self.mu_class[k] = n_new, mu_new
+        return vecs
+
+    def partial_fit(self, data, label):
+        # data: (samples, feat), label: integer classes (samples, 1)
+        data = np.asarray(data, dtype=np.float64)
+        label = np.asarray(label).reshape(-1)
+        self.grow(int(np.max(label)) + 1)
+        vecs = [self.merge(k, data[label == k], 1) for k in np.unique(label)]
+        self.rank_update(np.concatenate(vecs), 1)
+        return self
+
+    def forget(self, label, data=None):
+        # drop a block of samples previously given to partial_fit, or with data None every sample of the
+        # class(es) in label
+        if data is not None:
+            data = np.asarray(data, dtype=np.float64)
+            label = np.asarray(label).reshape(-1)
+            if np.max(label) >= self.n_class or np.any(np.bincount(label, minlength=self.n_class) > self.count):
+                raise ValueError('forgetting more samples than a class holds')
+            vecs = [self.merge(k, data[label == k], -1) for k in np.unique(label)]
+            self.rank_update(np.concatenate(vecs), -1)
+            return self
+
+        for k in np.unique(label):
+            # the class scatter leaves S_w as downdates along its eigenvectors
+            eig, vec = np.linalg.eigh(self.scatter[k])
+            keep = eig > 0
+            self.rank_update((vec[:,keep] * np.sqrt(eig[keep])).T, -1)
+            self.count[k] = 0
+            self.mu_class[k] = 0
+            self.scatter[k] = 0
+        return self
+
+    def cov(self):
+        n_present = np.sum(self.count > 0)
+        return self.S_w / (np.sum(self.count) - n_present)
+
+    def factor(self):
+        # Cholesky factor of S_w, refactorised from S_w only when an update could not be carried over
+        if self.L is None:
+            factor = lda_factor(self.S_w, self.rcond)
+            self.L = None if factor is None else np.tril(factor[0])
+        if self.L is not None:
+            pivots = np.diag(self.L)**2
+            if not pivots.min() > self.rcond * pivots.max():
+                self.L = None
+        return self.L
+
+    def coef(self):
+        # weights (n_class, feat) and biases (n_class, 1) as train_lda, classes without samples are never predicted
+        if self.coef_cache is None:
+            present = self.count > 0
+            n_present = np.sum(present)
+            L = self.factor()
+            if L is None:
+                w = lda_solve(self.cov(), self.mu_class.T).T
+            else:
+                w = (np.sum(self.count) - n_present) * cho_solve((L, True), self.mu_class.T, check_finite=False).T
+            c = -.5 * np.sum(w * self.mu_class, axis=1, keepdims=True) + np.log(1 / n_present)
+            c[~present] = -np.inf
+            self.coef_cache = w.astype(prd.DTYPE), c.astype(prd.DTYPE)
+        return self.coef_cache
+
+    def predict(self, data):
+        w, c = self.coef()
+        return predict(data, w, c)
+
+def group_stats(data, label, groups, n_class=None):
+    # one pass sufficient statistics per group and class: counts (G, n_class), sums (G, n_class, feat) and
+    # cross-products (G, n_class, feat, feat) of the data less its class's overall mean, which keeps the
+    # differences taken in cv_lda well conditioned. Returns the group ids, the class means and the statistics
+    data = np.asarray(data, dtype=np.float64)
+    label = np.asarray(label).reshape(-1)
+    if n_class is None:
+        n_class = int(np.max(label)) + 1
+    ids, g = np.unique(np.asarray(groups).reshape(-1), return_inverse=True)
+    g = g.reshape(-1)
+
+    count_all = np.bincount(label, minlength=n_class)
+    mu_all = np.zeros((n_class, data.shape[1]))
+    np.add.at(mu_all, label, data)
+    mu_all /= np.maximum(count_all, 1)[:,np.newaxis]
+    centred = data - mu_all[label]
+
+    # contiguous blocks of each (group, class) pair, each block's products in one matmul
+    block = g * n_class + label
+    order = np.argsort(block, kind='stable')
+    bounds = np.searchsorted(block[order], np.arange(ids.shape[0] * n_class + 1))
+    count = np.diff(bounds).reshape(ids.shape[0], n_class)
+    sums = np.zeros((ids.shape[0] * n_class, data.shape[1]))
+    cross = np.zeros((ids.shape[0] * n_class, data.shape[1], data.shape[1]))
+    for b in np.nonzero(np.diff(bounds))[0]:
+        rows = centred[order[bounds[b]:bounds[b+1]]]
+        sums[b] = np.sum(rows, axis=0)
+        cross[b] = np.dot(rows.T, rows)
+    return ids, mu_all, count, sums.reshape(count.shape + (-1,)), cross.reshape(count.shape + cross.shape[1:])
+
+# LDA trained on all groups but one, for every group: groups are e.g. params[:,0] for leave-one-subject-out
+# or params[:,6] for cv folds. The fold models come from the totals less the held-out group's statistics
+def cv_lda(data, label, groups, n_class=None):
+    ids, mu_all, count, sums, cross = group_stats(data, label, groups, n_class)
+    n = np.sum(count, axis=0) - count
+    d = np.sum(sums, axis=0) - sums
+    q = np.sum(cross, axis=0) - cross
+
+    # train_lda's class means and mean of the unbiased class covariances, over the classes left in each fold
+    present = n > 0
+    n_safe = np.maximum(n, 1)[...,np.newaxis]
+    mu_class = mu_all + d / n_safe
+    scatter = q - d[...,:,np.newaxis] * d[...,np.newaxis,:] / n_safe[...,np.newaxis]
+    n_present = np.sum(present, axis=1, keepdims=True)
+    scale = np.where(present, 1 / (np.maximum(n - 1, 1) * n_present), 0)
+    C = np.sum(scatter * scale[...,np.newaxis,np.newaxis], axis=1)
+
+    w = np.swapaxes(batch_solve(C, np.swapaxes(mu_class, 1, 2)), 1, 2)
+    c = -.5 * np.sum(w * mu_class, axis=2) + np.log(1 / n_present)
+    c[~present] = -np.inf
+    return ids, w.astype(prd.DTYPE), c[...,np.newaxis].astype(prd.DTYPE)
+
+def cv_eval_lda(data, label, groups, n_class=None):
+    # held-out accuracy of every fold model of cv_lda on its own group
+    ids, w, c = cv_lda(data, label, groups, n_class)
+    g = np.searchsorted(ids, np.asarray(groups).reshape(-1))
+    label = np.asarray(label).reshape(-1)
+    acc = np.zeros(ids.shape[0])
+    for i in range(ids.shape[0]):
+        rows = g == i
+        acc[i] = np.mean(predict(data[rows], w[i], c[i]) == label[rows])
+    return ids, acc
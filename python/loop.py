@@ -6,11 +6,10 @@ import os
 import pickle
 
 from sklearn.model_selection import train_test_split
-from tensorflow.keras.utils import to_categorical
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis as QDA
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
-from lda import train_lda, predict, eval_lda, eval_lda_ch
+from lda import train_lda, predict, eval_lda, eval_lda_ch, train_lda_batch, eval_lda_batch
 from sklearn.utils import shuffle
 import sVAE_utils as dl
 import process_data as prd
@@ -18,7 +17,7 @@ import copy as cp
 from datetime import date
 import time
 
-def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=True, batch_size=32, latent_dim=4, epochs=30,train_scale=5, n_train='gauss', n_test='gauss',feat_type='feat', noise=True, start_cv = 1, max_cv = 5, suf =''):
+def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=True, batch_size=32, latent_dim=4, epochs=30,train_scale=5, n_train='gauss', n_test='gauss',feat_type='feat', noise=True, start_cv = 1, max_cv = 5, suf ='', seed=None, antialias=False):
     i_tot = 13
     if n_test == 0:
         noise_type = 'none'
@@ -45,15 +44,21 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
     if not os.path.exists(foldername):
         os.makedirs(foldername)
 
+    # Features are reused across models and cv folds; only seeded noise repeats across runs, so only then
+    # are evicted features kept on disk
+    feat_cache = prd.FeatCache(folder=None if seed is None else foldername + '/feat_cache')
+    # rows of each subject and group are looked up from one sorted index of params
+    pidx = prd.ParamsIndex(params)
+
     for sub in range(1,np.max(params[:,0])+1):            
-        ind = (params[:,0] == sub) & (params[:,3] == train_grp)
+        ind = prd.sub_rows(params, sub, train_grp, pidx)
 
         # Check if training data exists
-        if np.sum(ind):
+        if ind.size:
             if dt == 'cv':
-                x_full, x_test, _, p_full, p_test, _ = prd.train_data_split(raw,params,sub,sub_type,dt=dt)
+                x_full, x_test, _, p_full, p_test, _ = prd.train_data_split(raw,params,sub,sub_type,dt=dt,pidx=pidx)
             else:
-                x_train, x_test, x_valid, p_train, p_test, p_valid = prd.train_data_split(raw,params,sub,sub_type,dt=dt)
+                x_train, x_test, x_valid, p_train, p_test, p_valid = prd.train_data_split(raw,params,sub,sub_type,dt=dt,pidx=pidx)
 
             for cv in range(start_cv,max_cv):
                 filename = foldername + '/' + sub_type + str(sub) + '_' + feat_type + '_dim_' + str(latent_dim) + '_ep_' + str(epochs) + '_bat_' + str(batch_size) + '_' + n_train + '_' + str(train_scale)
@@ -66,6 +71,8 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
                 if sparsity:
                     filename += '_sparse'
                 
+                if antialias:
+                    filename += '_aa'
                 filename += suf
 
                 # Load saved data
@@ -75,30 +82,42 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
                         scaler, svae_w, svae_enc_w, svae_dec_w, svae_clf_w, sae_w, sae_enc_w, sae_clf_w, cnn_w, cnn_enc_w, cnn_clf_w, vcnn_w, vcnn_enc_w, vcnn_clf_w, w_svae, c_svae, \
                             w_sae, c_sae, w_cnn, c_cnn, w_vcnn, c_vcnn, w, c, w_noise, c_noise, mu, C = pickle.load(f)   
                 else:
-                    scaler = MinMaxScaler(feature_range=(-1,1))
+                    scaler = None
                     load = False
                 # else:
                 y_train = p_train[:,4]
                 
-                x_train_noise, x_train_clean, y_train_clean = prd.add_noise(x_train, p_train, sub, n_train, train_scale)
-                x_valid_noise, x_valid_clean, y_valid_clean = prd.add_noise(x_valid, p_valid, sub, n_train, train_scale)
-                if not noise:
+                x_train_noise, x_train_clean, y_train_clean, train_plan = prd.add_noise(x_train, p_train, sub, n_train, train_scale, seed=seed, split='train' + str(cv), return_plan=True)
+                x_valid_noise, x_valid_clean, y_valid_clean, valid_plan = prd.add_noise(x_valid, p_valid, sub, n_train, train_scale, seed=seed, split='valid' + str(cv), return_plan=True)
+
+                # Features of the clean windows once, the noisy rows only re-extract their corrupted channels;
+                # add_noise rounds raw to prd.DTYPE, so its features come from the rounded windows
+                x_train_lda = feat_cache.extract(x_train)
+                x_train_feat = feat_cache.extract(np.asarray(x_train, dtype=prd.DTYPE))
+                x_valid_feat = feat_cache.extract(np.asarray(x_valid, dtype=prd.DTYPE))
+                f_train_clean = np.tile(x_train_feat, (x_train_clean.shape[0]//x_train.shape[0], 1))
+                f_valid_clean = np.tile(x_valid_feat, (x_valid_clean.shape[0]//x_valid.shape[0], 1))
+                if noise:
+                    f_train_noise = prd.noise_feats(x_train, *train_plan, clean_feats=x_train_feat)
+                    f_valid_noise = prd.noise_feats(x_valid, *valid_plan, clean_feats=x_valid_feat)
+                else:
                     x_train_noise = cp.deepcopy(x_train_clean)
                     x_valid_noise = cp.deepcopy(x_valid_clean)
+                    f_train_noise, f_valid_noise = f_train_clean, f_valid_clean
 
-                x_train_noise, x_train_clean, y_train_clean = shuffle(x_train_noise, x_train_clean, y_train_clean, random_state = 0)
+                x_train_noise, x_train_clean, y_train_clean, f_train_noise, f_train_clean = shuffle(x_train_noise, x_train_clean, y_train_clean, f_train_noise, f_train_clean, random_state = 0)
 
                 # Build VAE
-                svae, svae_enc, svae_dec, svae_clf = dl.build_svae(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-                sae, sae_enc, sae_clf = dl.build_sae(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-                cnn, cnn_enc, cnn_clf = dl.build_cnn(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-                vcnn, vcnn_enc, vcnn_clf = dl.build_vcnn(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
+                n_class = int(np.max(y_train_clean)) + 1
+                svae, svae_enc, svae_dec, svae_clf = dl.build_svae(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+                sae, sae_enc, sae_clf = dl.build_sae(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+                cnn, cnn_enc, cnn_clf = dl.build_cnn(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+                vcnn, vcnn_enc, vcnn_clf = dl.build_vcnn(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
 
                 # Training data for LDA/QDA
-                x_train_lda = prd.extract_feats(x_train)
                 y_train_lda = y_train[...,np.newaxis] - 1
-                x_train_lda2 = prd.extract_feats(x_train_noise)
-                y_train_lda2 = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
+                x_train_lda2 = f_train_noise
+                y_train_lda2 = y_train_clean
 
                 # Train QDA
                 qda = QDA()
@@ -108,23 +127,25 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
 
                 if not load:
                     if feat_type == 'feat':
-                        x_train_noise_temp = np.transpose(prd.extract_feats(x_train_noise).reshape((x_train_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                        x_train_clean_temp = np.transpose(prd.extract_feats(x_train_clean).reshape((x_train_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                        x_train_noise_vae = scaler.fit_transform(x_train_noise_temp.reshape(x_train_noise_temp.shape[0]*x_train_noise_temp.shape[1],-1)).reshape(x_train_noise_temp.shape)
+                        x_train_noise_temp = prd.flat_to_ch(f_train_noise)[...,np.newaxis]
+                        x_train_clean_temp = prd.flat_to_ch(f_train_clean)[...,np.newaxis]
+                        # Scale each feature to [-1, 1] across windows and channels, cached features are read only
+                        scaler = prd.minmax_fit(x_train_noise_temp, n_feat=4)
+                        x_train_noise_vae = prd.minmax_apply(x_train_noise_temp, scaler)
                         
-                        x_train_vae = scaler.transform(x_train_clean_temp.reshape(x_train_clean_temp.shape[0]*x_train_clean_temp.shape[1],-1)).reshape(x_train_clean_temp.shape)
+                        x_train_vae = prd.minmax_apply(x_train_clean_temp, scaler)
 
-                        x_valid_noise_temp = np.transpose(prd.extract_feats(x_valid_noise).reshape((x_valid_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                        x_valid_clean_temp = np.transpose(prd.extract_feats(x_valid_clean).reshape((x_valid_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                        x_valid_noise_vae = scaler.transform(x_valid_noise_temp.reshape(x_valid_noise_temp.shape[0]*x_valid_noise_temp.shape[1],-1)).reshape(x_valid_noise_temp.shape)
+                        x_valid_noise_temp = prd.flat_to_ch(f_valid_noise)[...,np.newaxis]
+                        x_valid_clean_temp = prd.flat_to_ch(f_valid_clean)[...,np.newaxis]
+                        x_valid_noise_vae = prd.minmax_apply(x_valid_noise_temp, scaler)
                         
-                        x_valid_vae = scaler.transform(x_valid_clean_temp.reshape(x_valid_clean_temp.shape[0]*x_valid_clean_temp.shape[1],-1)).reshape(x_valid_clean_temp.shape)
+                        x_valid_vae = prd.minmax_apply(x_valid_clean_temp, scaler)
                     elif feat_type == 'raw':
-                        x_train_noise_vae = cp.deepcopy(x_train_noise[:,:,::2,:])/5
-                        x_train_vae = cp.deepcopy(x_train_clean[:,:,::2,:])/5
+                        x_train_noise_vae = prd.raw_input(x_train_noise, antialias=antialias)
+                        x_train_vae = prd.raw_input(x_train_clean, antialias=antialias)
 
-                        x_valid_noise_vae = cp.deepcopy(x_valid_noise[:,:,::2,:])/5
-                        x_valid_vae = cp.deepcopy(x_valid_clean[:,:,::2,:])/5
+                        x_valid_noise_vae = prd.raw_input(x_valid_noise, antialias=antialias)
+                        x_valid_vae = prd.raw_input(x_valid_clean, antialias=antialias)
 
                     x_train_noise_sae = x_train_noise_vae.reshape(x_train_noise_vae.shape[0],-1)
                     x_train_sae = x_train_vae.reshape(x_train_vae.shape[0],-1)
@@ -159,13 +180,12 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
                     x_train_cnn = cnn_enc.predict(x_train_noise_vae)
                     _, _, x_train_vcnn = vcnn_enc.predict(x_train_noise_vae)
 
-                    y_train_aligned = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
+                    y_train_aligned = y_train_clean
 
-                    # Train ENC-LDA
-                    w_svae, c_svae,_, _ = train_lda(x_train_svae,y_train_aligned)
-                    w_sae, c_sae,_, _ = train_lda(x_train_sae,y_train_aligned)
-                    w_cnn, c_cnn,_, _ = train_lda(x_train_cnn,y_train_aligned)
-                    w_vcnn, c_vcnn, _, _ = train_lda(x_train_vcnn,y_train_aligned)
+                    # Train ENC-LDA, the four encoders as one stack
+                    w_enc, c_enc, _, _ = train_lda_batch(np.stack([x_train_svae, x_train_sae, x_train_cnn, x_train_vcnn]), y_train_aligned)
+                    w_svae, w_sae, w_cnn, w_vcnn = w_enc
+                    c_svae, c_sae, c_cnn, c_vcnn = c_enc
 
                     # Train LDA
                     w,c, mu, C = train_lda(x_train_lda,y_train_lda)
@@ -210,12 +230,13 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
                     # load test data for diff limb positions
                     if noise_type == 'pos':
                         test_grp = int(n_test[-1])
-                        _, x_test, _, _, p_test, _ = prd.train_data_split(raw,params,sub,sub_type,dt=dt,train_grp=test_grp)
+                        _, x_test, _, _, p_test, _ = prd.train_data_split(raw,params,sub,sub_type,dt=dt,train_grp=test_grp,pidx=pidx)
                         pos_ind = p_test[:,-1] == test_scale
                         if pos_ind.any():
                             x_test_noise = x_test[pos_ind,...]
                             x_test_clean = x_test[pos_ind,...]
-                            y_test_clean = to_categorical(p_test[pos_ind,4]-1)
+                            f_test_noise = f_test_clean = feat_cache.extract(x_test_noise)
+                            y_test_clean = prd.class_labels(p_test[pos_ind,4])
                             clean_size = 0
                             skip = False
                         else:
@@ -224,25 +245,30 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
                         # Add noise and index EMG data
                         if noise_type == 'none':
                             x_test_noise, x_test_clean, y_test_clean = x_valid_noise, x_valid_clean, y_valid_clean
+                            f_test_noise, f_test_clean = f_valid_noise, f_valid_clean
                             clean_size = int(np.size(x_valid,axis=0))
                         else:
-                            x_test_noise, x_test_clean, y_test_clean = prd.add_noise(x_test, p_test, sub, n_test, test_scale)
+                            x_test_noise, x_test_clean, y_test_clean, test_plan = prd.add_noise(x_test, p_test, sub, n_test, test_scale, seed=seed, split='test', return_plan=True)
+                            x_test_feat = feat_cache.extract(np.asarray(x_test, dtype=prd.DTYPE))
+                            f_test_noise = prd.noise_feats(x_test, *test_plan, clean_feats=x_test_feat)
+                            f_test_clean = np.tile(x_test_feat, (x_test_clean.shape[0]//x_test.shape[0], 1))
                             clean_size = int(np.size(x_test,axis=0))
                         if not noise:
                             x_test_noise = cp.deepcopy(x_test_clean)
+                            f_test_noise = f_test_clean
 
                     if not skip:
                         # Extract features
                         if feat_type == 'feat':
-                            x_test_noise_temp = np.transpose(prd.extract_feats(x_test_noise).reshape((x_test_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                            x_test_clean_temp = np.transpose(prd.extract_feats(x_test_clean).reshape((x_test_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
+                            x_test_noise_temp = prd.flat_to_ch(f_test_noise)[...,np.newaxis]
+                            x_test_clean_temp = prd.flat_to_ch(f_test_clean)[...,np.newaxis]
                             
-                            x_test_vae = scaler.transform(x_test_noise_temp.reshape(x_test_noise_temp.shape[0]*x_test_noise_temp.shape[1],-1)).reshape(x_test_noise_temp.shape)
-                            x_test_clean_vae = scaler.transform(x_test_clean_temp.reshape(x_test_clean_temp.shape[0]*x_test_clean_temp.shape[1],-1)).reshape(x_test_clean_temp.shape)
+                            x_test_vae = prd.minmax_apply(x_test_noise_temp, scaler)
+                            x_test_clean_vae = prd.minmax_apply(x_test_clean_temp, scaler)
                         
                         elif feat_type == 'raw':
-                            x_test_vae = cp.deepcopy(x_test_noise[:,:,::2,:])/5
-                            x_test_clean_vae = cp.deepcopy(x_test_clean[:,:,::2,:])/5
+                            x_test_vae = prd.raw_input(x_test_noise, antialias=antialias)
+                            x_test_clean_vae = prd.raw_input(x_test_clean, antialias=antialias)
 
                         # Reshape for nonconvolutional SAE
                         x_test_dlsae = x_test_vae.reshape(x_test_vae.shape[0],-1)
@@ -254,11 +280,11 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
                         x_test_cnn = cnn_enc.predict(x_test_vae)
                         _, _, x_test_vcnn = vcnn_enc.predict(x_test_vae)
 
-                        y_test_aligned = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
+                        y_test_aligned = y_test_clean
 
                         # Non NN methods
-                        x_test_lda = prd.extract_feats(x_test_noise)
-                        y_test_lda = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
+                        x_test_lda = f_test_noise
+                        y_test_lda = y_test_clean
 
                         y_test_ch = y_test_lda[:y_test_lda.shape[0]//2,...]
 
@@ -291,6 +317,8 @@ def loop_noise(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=T
     with open(resultsfile + '_results.p', 'wb') as f:
         pickle.dump([acc_all, acc_clean, acc_noise],f)
 
+    feat_cache.flush()
+    print('Feature cache: ' + str(feat_cache.stats()))
     return acc_all, acc_noise, acc_clean, filename
 
 def run_loop(raw, params, sub_type, nn='svae', load=True, batch_size=128, latent_dim=3, epochs=30,train_scale=5, test_scale=5, n_train='gauss', n_test='gauss',feat_type='feat'): 
@@ -307,14 +335,16 @@ def run_loop(raw, params, sub_type, nn='svae', load=True, batch_size=128, latent
     dec_w = 0
     clf_w = 0
 
+    # rows of each subject and group are looked up from one sorted index of params
+    pidx = prd.ParamsIndex(params)
     # Loop through subjects
     for sub in range(1,np.max(params[:,0])+1):
         # Loop through training groups
         for train_grp in range(2,3):#np.max(params[:,3])+1):
-            ind = (params[:,0] == sub) & (params[:,3] == train_grp)
+            ind = prd.sub_rows(params, sub, train_grp, pidx)
 
             # Check if training data exists
-            if np.sum(ind):
+            if ind.size:
                 print('Running sub ' + str(sub) + ', model ' + str(train_grp))
                 # Set folder and file names
                 foldername = 'models_' + str(train_grp)
@@ -346,10 +376,10 @@ def run_loop(raw, params, sub_type, nn='svae', load=True, batch_size=128, latent
 
                 # Extract and scale features
                 if feat_type == 'feat':
-                    x_train_noise_temp = np.transpose(prd.extract_feats(x_train_noise).reshape((x_train_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_test_noise_temp = np.transpose(prd.extract_feats(x_test_noise).reshape((x_test_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_train_clean_temp = np.transpose(prd.extract_feats(x_train_clean).reshape((x_train_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_test_clean_temp = np.transpose(prd.extract_feats(x_test_clean).reshape((x_test_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
+                    x_train_noise_temp = prd.extract_feats(x_train_noise, layout='ch')[...,np.newaxis]
+                    x_test_noise_temp = prd.extract_feats(x_test_noise, layout='ch')[...,np.newaxis]
+                    x_train_clean_temp = prd.extract_feats(x_train_clean, layout='ch')[...,np.newaxis]
+                    x_test_clean_temp = prd.extract_feats(x_test_clean, layout='ch')[...,np.newaxis]
                     if load:
                         x_train_noise_vae = scaler.transform(x_train_noise_temp.reshape(x_train_noise_temp.shape[0]*x_train_noise_temp.shape[1],-1)).reshape(x_train_noise_temp.shape)
                     else:
@@ -365,14 +395,15 @@ def run_loop(raw, params, sub_type, nn='svae', load=True, batch_size=128, latent
                     x_test_clean_vae = cp.deepcopy(x_test_clean)/5
         
                 # Build VAE
+                n_class = int(np.max(y_train_clean)) + 1
                 if nn == 'svae':
-                    vae, encoder, decoder,clf = dl.build_svae(latent_dim, y_train_clean.shape[1], input_type=feat_type)
+                    vae, encoder, decoder,clf = dl.build_svae(latent_dim, n_class, input_type=feat_type)
                     y_fit = [x_train_vae,y_train_clean]
                 elif nn == 'vae':
                     vae, encoder, decoder = dl.build_vae(latent_dim, input_type=feat_type)
                     y_fit = x_train_vae
                 elif nn == 'sae':
-                    vae, encoder, clf = dl.build_sae(latent_dim, y_train_clean.shape[1], input_type=feat_type)
+                    vae, encoder, clf = dl.build_sae(latent_dim, n_class, input_type=feat_type)
                     y_fit = y_train_clean
 
                 # Fit sVAE and get weights
@@ -402,8 +433,8 @@ def run_loop(raw, params, sub_type, nn='svae', load=True, batch_size=128, latent
                 # Test encoder-LDA combo
                 _, _, x_train_aligned = encoder.predict(x_train_noise_vae)
                 _,_, x_test_aligned = encoder.predict(x_test_vae)
-                y_train_aligned = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
-                y_test_aligned = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
+                y_train_aligned = y_train_clean
+                y_test_aligned = y_test_clean
                 w_aligned, c_aligned = train_lda(x_train_aligned,y_train_aligned)
                 acc_all[sub-1,1] = eval_lda(w_aligned, c_aligned, x_test_aligned, y_test_aligned)
                 acc_noise[sub-1,1] = eval_lda(w_aligned, c_aligned, x_test_aligned[clean_size:,:], y_test_aligned[clean_size:,:])
@@ -413,7 +444,7 @@ def run_loop(raw, params, sub_type, nn='svae', load=True, batch_size=128, latent
                 x_train_lda = prd.extract_feats(x_train)
                 x_test_lda = prd.extract_feats(x_test_noise)
                 y_train_lda = y_train[...,np.newaxis] - 1
-                y_test_lda = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
+                y_test_lda = y_test_clean
                 w,c = train_lda(x_train_lda,y_train_lda)
                 acc_all[sub-1,2] = eval_lda(w, c, x_test_lda, y_test_lda)
                 acc_noise[sub-1,2] = eval_lda(w, c, x_test_lda[clean_size:,:], y_test_lda[clean_size:,:])
@@ -421,7 +452,7 @@ def run_loop(raw, params, sub_type, nn='svae', load=True, batch_size=128, latent
 
                 # LDA trained with corrupted data
                 x_train_lda2 = prd.extract_feats(x_train_noise)
-                y_train_lda2 = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
+                y_train_lda2 = y_train_clean
                 w_noise,c_noise = train_lda(x_train_lda2,y_train_lda2)
                 acc_all[sub-1,3] = eval_lda(w_noise, c_noise, x_test_lda, y_test_lda)
                 acc_noise[sub-1,3] = eval_lda(w_noise, c_noise, x_test_lda[clean_size:,:], y_test_lda[clean_size:,:])
@@ -463,13 +494,15 @@ def loop_sub(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=Tru
     if not os.path.exists(foldername):
         os.makedirs(foldername)
 
+    # rows of each subject and group are looked up from one sorted index of params
+    pidx = prd.ParamsIndex(params)
     # Loop through subjects
     for sub in range(1,np.max(params[:,0])+1):            
-        ind = (params[:,0] == sub) & (params[:,3] == train_grp)
+        ind = prd.sub_rows(params, sub, train_grp, pidx)
 
         # Check if training data exists
-        if np.sum(ind):
-            x_train, x_test, x_valid, p_train, p_test, p_valid = prd.train_data_split(raw,params,sub,sub_type,dt=dt)
+        if ind.size:
+            x_train, x_test, x_valid, p_train, p_test, p_valid = prd.train_data_split(raw,params,sub,sub_type,dt=dt,pidx=pidx)
             scaler = MinMaxScaler(feature_range=(-1,1))
             print('Running sub ' + str(sub) + ', model ' + str(train_grp) + ', latent dim ' + str(latent_dim))
             filename = foldername + '/' + sub_type + str(sub) + '_' + feat_type + '_dim_' + str(latent_dim) + '_ep_' + str(epochs) + '_' + n_train + '_' + str(train_scale)
@@ -500,16 +533,17 @@ def loop_sub(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=Tru
                 x_test_noise = cp.deepcopy(x_test_clean)
 
             # Build VAE
-            svae, svae_enc, svae_dec, svae_clf = dl.build_svae(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-            sae, sae_enc, sae_clf = dl.build_sae(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-            cnn, cnn_enc, cnn_clf = dl.build_cnn(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-            vcnn, vcnn_enc, vcnn_clf = dl.build_vcnn(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
+            n_class = int(np.max(y_train_clean)) + 1
+            svae, svae_enc, svae_dec, svae_clf = dl.build_svae(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+            sae, sae_enc, sae_clf = dl.build_sae(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+            cnn, cnn_enc, cnn_clf = dl.build_cnn(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+            vcnn, vcnn_enc, vcnn_clf = dl.build_vcnn(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
 
             # Training data for LDA/QDA
             x_train_lda = prd.extract_feats(x_train)
             y_train_lda = y_train[...,np.newaxis] - 1
             x_train_lda2 = prd.extract_feats(x_train_noise)
-            y_train_lda2 = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
+            y_train_lda2 = y_train_clean
 
             # Train QDA
             qda = QDA()
@@ -519,16 +553,16 @@ def loop_sub(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=Tru
 
             if not load:
                 if feat_type == 'feat':
-                    x_train_noise_temp = np.transpose(prd.extract_feats(x_train_noise).reshape((x_train_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_train_clean_temp = np.transpose(prd.extract_feats(x_train_clean).reshape((x_train_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
+                    x_train_noise_temp = prd.extract_feats(x_train_noise, layout='ch')[...,np.newaxis]
+                    x_train_clean_temp = prd.extract_feats(x_train_clean, layout='ch')[...,np.newaxis]
                     x_train_noise_vae = scaler.fit_transform(x_train_noise_temp.reshape(x_train_noise_temp.shape[0]*x_train_noise_temp.shape[1],-1)).reshape(x_train_noise_temp.shape)
                     
                     x_train_vae = scaler.transform(x_train_clean_temp.reshape(x_train_clean_temp.shape[0]*x_train_clean_temp.shape[1],-1)).reshape(x_train_clean_temp.shape)
                     x_train_noise_sae = x_train_noise_vae.reshape(x_train_noise_vae.shape[0],-1)
                     x_train_sae = x_train_vae.reshape(x_train_vae.shape[0],-1)
 
-                    x_valid_noise_temp = np.transpose(prd.extract_feats(x_valid_noise).reshape((x_valid_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_valid_clean_temp = np.transpose(prd.extract_feats(x_valid_clean).reshape((x_valid_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
+                    x_valid_noise_temp = prd.extract_feats(x_valid_noise, layout='ch')[...,np.newaxis]
+                    x_valid_clean_temp = prd.extract_feats(x_valid_clean, layout='ch')[...,np.newaxis]
                     x_valid_noise_vae = scaler.transform(x_valid_noise_temp.reshape(x_valid_noise_temp.shape[0]*x_valid_noise_temp.shape[1],-1)).reshape(x_valid_noise_temp.shape)
                     
                     x_valid_vae = scaler.transform(x_valid_clean_temp.reshape(x_valid_clean_temp.shape[0]*x_valid_clean_temp.shape[1],-1)).reshape(x_valid_clean_temp.shape)
@@ -566,13 +600,12 @@ def loop_sub(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=Tru
                 x_train_cnn = cnn_enc.predict(x_train_noise_vae)
                 _, _, x_train_vcnn = vcnn_enc.predict(x_train_noise_vae)
 
-                y_train_aligned = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
+                y_train_aligned = y_train_clean
 
-                # Train ENC-LDA
-                w_svae, c_svae, _, _ = train_lda(x_train_svae,y_train_aligned)
-                w_sae, c_sae, _, _ = train_lda(x_train_sae,y_train_aligned)
-                w_cnn, c_cnn, _, _ = train_lda(x_train_cnn,y_train_aligned)
-                w_vcnn, c_vcnn, _, _ = train_lda(x_train_vcnn,y_train_aligned)
+                # Train ENC-LDA, the four encoders as one stack
+                w_enc, c_enc, _, _ = train_lda_batch(np.stack([x_train_svae, x_train_sae, x_train_cnn, x_train_vcnn]), y_train_aligned)
+                w_svae, w_sae, w_cnn, w_vcnn = w_enc
+                c_svae, c_sae, c_cnn, c_vcnn = c_enc
 
                 # Train LDA
                 w,c, mu, C = train_lda(x_train_lda,y_train_lda)
@@ -602,8 +635,8 @@ def loop_sub(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=Tru
 
             # Extract features
             if feat_type == 'feat':
-                x_test_noise_temp = np.transpose(prd.extract_feats(x_test_noise).reshape((x_test_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                x_test_clean_temp = np.transpose(prd.extract_feats(x_test_clean).reshape((x_test_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
+                x_test_noise_temp = prd.extract_feats(x_test_noise, layout='ch')[...,np.newaxis]
+                x_test_clean_temp = prd.extract_feats(x_test_clean, layout='ch')[...,np.newaxis]
                 
                 x_test_vae = scaler.transform(x_test_noise_temp.reshape(x_test_noise_temp.shape[0]*x_test_noise_temp.shape[1],-1)).reshape(x_test_noise_temp.shape)
                 x_test_clean_vae = scaler.transform(x_test_clean_temp.reshape(x_test_clean_temp.shape[0]*x_test_clean_temp.shape[1],-1)).reshape(x_test_clean_temp.shape)
@@ -621,11 +654,11 @@ def loop_sub(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=Tru
             x_test_sae = sae_enc.predict(x_test_dlsae)
             x_test_cnn = cnn_enc.predict(x_test_vae)
             _, _, x_test_vcnn = vcnn_enc.predict(x_test_vae)
-            y_test_aligned = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
+            y_test_aligned = y_test_clean
 
             # Non NN methods
             x_test_lda = prd.extract_feats(x_test_noise)
-            y_test_lda = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
+            y_test_lda = y_test_clean
 
             y_test_ch = y_test_lda[:y_test_lda.shape[0]//2,...]
 
@@ -650,7 +683,7 @@ def loop_sub(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=Tru
 
     return acc_all, acc_noise, acc_clean, filename
 
-def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=True, batch_size=128, latent_dim=3, epochs=30,train_scale=5, test_scale=5, n_train='gauss', n_test='gauss',feat_type='feat', noise=True):
+def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=True, batch_size=128, latent_dim=3, epochs=30,train_scale=5, test_scale=5, n_train='gauss', n_test='gauss',feat_type='feat', noise=True, antialias=False):
     i_tot = 12
     lat_tot = 8
     sub_all = np.zeros([np.max(params[:,0])+1, lat_tot, i_tot])
@@ -666,15 +699,17 @@ def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=
     if not os.path.exists(foldername):
         os.makedirs(foldername)
 
+    # rows of each subject and group are looked up from one sorted index of params
+    pidx = prd.ParamsIndex(params)
     for sub in range(1,np.max(params[:,0])+1):            
         acc_all = np.zeros([lat_tot,i_tot])
         acc_clean = np.zeros([lat_tot,i_tot])
         acc_noise = np.zeros([lat_tot,i_tot])
-        ind = (params[:,0] == sub) & (params[:,3] == train_grp)
+        ind = prd.sub_rows(params, sub, train_grp, pidx)
 
         # Check if training data exists
-        if np.sum(ind):
-            x_train, x_test, p_train, p_test = prd.train_data_split(raw,params,sub,sub_type,dt=dt)
+        if ind.size:
+            x_train, x_test, p_train, p_test = prd.train_data_split(raw,params,sub,sub_type,dt=dt,pidx=pidx)
             for latent_dim in range(1,9):
                 latent_i = latent_dim - 1
                 scaler = MinMaxScaler(feature_range=(-1,1))
@@ -682,6 +717,8 @@ def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=
                 filename = foldername + '/' + sub_type + str(sub) + '_' + feat_type + '_dim_' + str(latent_dim) + '_ep_' + str(epochs) + '_' + n_train + '_' + str(train_scale)
                 if sparsity:
                     filename = filename + '_sparse'
+                if antialias:
+                    filename = filename + '_aa'
                 # if os.path.isfile(filename):
                 #     load = 'False'
                 # else:
@@ -711,10 +748,10 @@ def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=
 
                 # Extract features
                 if feat_type == 'feat':
-                    x_train_noise_temp = np.transpose(prd.extract_feats(x_train_noise).reshape((x_train_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_test_noise_temp = np.transpose(prd.extract_feats(x_test_noise).reshape((x_test_noise.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_train_clean_temp = np.transpose(prd.extract_feats(x_train_clean).reshape((x_train_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
-                    x_test_clean_temp = np.transpose(prd.extract_feats(x_test_clean).reshape((x_test_clean.shape[0],4,-1)),(0,2,1))[...,np.newaxis]
+                    x_train_noise_temp = prd.extract_feats(x_train_noise, layout='ch')[...,np.newaxis]
+                    x_test_noise_temp = prd.extract_feats(x_test_noise, layout='ch')[...,np.newaxis]
+                    x_train_clean_temp = prd.extract_feats(x_train_clean, layout='ch')[...,np.newaxis]
+                    x_test_clean_temp = prd.extract_feats(x_test_clean, layout='ch')[...,np.newaxis]
                     if load:
                         x_train_noise_vae = scaler.transform(x_train_noise_temp.reshape(x_train_noise_temp.shape[0]*x_train_noise_temp.shape[1],-1)).reshape(x_train_noise_temp.shape)
                     else:
@@ -730,16 +767,22 @@ def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=
                     x_test_sae = x_test_vae.reshape(x_test_vae.shape[0],-1)
                     x_test_clean_sae = x_test_clean_vae.reshape(x_test_clean_vae.shape[0],-1)
                 elif feat_type == 'raw':
-                    x_train_noise_temp = cp.deepcopy(x_train_noise)/5
-                    x_test_noise_temp = cp.deepcopy(x_test_noise)/5
-                    x_train_clean_temp = cp.deepcopy(x_train_clean)/5
-                    x_test_clean_temp = cp.deepcopy(x_test_clean)/5
+                    x_train_noise_vae = prd.raw_input(x_train_noise, antialias=antialias)
+                    x_test_vae = prd.raw_input(x_test_noise, antialias=antialias)
+                    x_train_vae = prd.raw_input(x_train_clean, antialias=antialias)
+                    x_test_clean_vae = prd.raw_input(x_test_clean, antialias=antialias)
+
+                    x_train_noise_sae = x_train_noise_vae.reshape(x_train_noise_vae.shape[0],-1)
+                    x_train_sae = x_train_vae.reshape(x_train_vae.shape[0],-1)
+                    x_test_sae = x_test_vae.reshape(x_test_vae.shape[0],-1)
+                    x_test_clean_sae = x_test_clean_vae.reshape(x_test_clean_vae.shape[0],-1)
 
                 # Build VAE
-                svae, svae_enc, svae_dec, svae_clf = dl.build_svae(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-                sae, sae_enc, sae_clf = dl.build_sae(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-                cnn, cnn_enc, cnn_clf = dl.build_cnn(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
-                vcnn, vcnn_enc, vcnn_clf = dl.build_vcnn(latent_dim, y_train_clean.shape[1], input_type=feat_type, sparse=sparsity)
+                n_class = int(np.max(y_train_clean)) + 1
+                svae, svae_enc, svae_dec, svae_clf = dl.build_svae(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+                sae, sae_enc, sae_clf = dl.build_sae(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+                cnn, cnn_enc, cnn_clf = dl.build_cnn(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
+                vcnn, vcnn_enc, vcnn_clf = dl.build_vcnn(latent_dim, n_class, input_type=feat_type, sparse=sparsity)
 
                 # Fit sVAE and get weights
                 if not load:
@@ -819,37 +862,22 @@ def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=
                 _, _, x_train_vcnn = vcnn_enc.predict(x_train_noise_vae)
                 _, _, x_test_vcnn = vcnn_enc.predict(x_test_vae)
 
-                y_train_aligned = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
-                y_test_aligned = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
-                w_svae, c_svae = train_lda(x_train_svae,y_train_aligned)
-                acc_all[latent_i,i] = eval_lda(w_svae, c_svae, x_test_svae, y_test_aligned)
-                acc_noise[latent_i,i] = eval_lda(w_svae, c_svae, x_test_svae[clean_size:,:], y_test_aligned[clean_size:,:])
-                acc_clean[latent_i,i] = eval_lda(w_svae, c_svae, x_test_svae[:clean_size,:], y_test_aligned[:clean_size,:])
-                i += 1
-
-                w_sae, c_sae = train_lda(x_train_sae,y_train_aligned)
-                acc_all[latent_i,i] = eval_lda(w_sae, c_sae, x_test_sae, y_test_aligned)
-                acc_noise[latent_i,i] = eval_lda(w_sae, c_sae, x_test_sae[clean_size:,:], y_test_aligned[clean_size:,:])
-                acc_clean[latent_i,i] = eval_lda(w_sae, c_sae, x_test_sae[:clean_size,:], y_test_aligned[:clean_size,:])
-                i += 1
-
-                w_cnn, c_cnn = train_lda(x_train_cnn,y_train_aligned)
-                acc_all[latent_i,i] = eval_lda(w_cnn, c_cnn, x_test_cnn, y_test_aligned)
-                acc_noise[latent_i,i] = eval_lda(w_cnn, c_cnn, x_test_cnn[clean_size:,:], y_test_aligned[clean_size:,:])
-                acc_clean[latent_i,i] = eval_lda(w_cnn, c_cnn, x_test_cnn[:clean_size,:], y_test_aligned[:clean_size,:])
-                i += 1
-
-                w_vcnn, c_vcnn = train_lda(x_train_vcnn,y_train_aligned)
-                acc_all[latent_i,i] = eval_lda(w_vcnn, c_vcnn, x_test_vcnn, y_test_aligned)
-                acc_noise[latent_i,i] = eval_lda(w_vcnn, c_vcnn, x_test_vcnn[clean_size:,:], y_test_aligned[clean_size:,:])
-                acc_clean[latent_i,i] = eval_lda(w_vcnn, c_vcnn, x_test_vcnn[:clean_size,:], y_test_aligned[:clean_size,:])
-                i += 1
+                y_train_aligned = y_train_clean
+                y_test_aligned = y_test_clean
+                # all four encoder LDAs share labels and latent size, trained and tested as one stack
+                x_train_enc = np.stack([x_train_svae, x_train_sae, x_train_cnn, x_train_vcnn])
+                x_test_enc = np.stack([x_test_svae, x_test_sae, x_test_cnn, x_test_vcnn])
+                w_enc, c_enc, _, _ = train_lda_batch(x_train_enc, y_train_aligned)
+                acc_all[latent_i,i:i+4] = eval_lda_batch(w_enc, c_enc, x_test_enc, y_test_aligned)
+                acc_noise[latent_i,i:i+4] = eval_lda_batch(w_enc, c_enc, x_test_enc[:,clean_size:,:], y_test_aligned[clean_size:,:])
+                acc_clean[latent_i,i:i+4] = eval_lda_batch(w_enc, c_enc, x_test_enc[:,:clean_size,:], y_test_aligned[:clean_size,:])
+                i += 4
 
                 # Baseline LDA
                 x_train_lda = prd.extract_feats(x_train)
                 x_test_lda = prd.extract_feats(x_test_noise)
                 y_train_lda = y_train[...,np.newaxis] - 1
-                y_test_lda = np.argmax(y_test_clean, axis=1)[...,np.newaxis]
+                y_test_lda = y_test_clean
                 w,c = train_lda(x_train_lda,y_train_lda)
                 acc_all[latent_i,i] = eval_lda(w, c, x_test_lda, y_test_lda)
                 acc_noise[latent_i,i] = eval_lda(w, c, x_test_lda[clean_size:,:], y_test_lda[clean_size:,:])
@@ -858,7 +886,7 @@ def loop_alldim(raw, params, sub_type, train_grp = 2, dt=0, sparsity=True, load=
 
                 # LDA trained with corrupted data
                 x_train_lda2 = prd.extract_feats(x_train_noise)
-                y_train_lda2 = np.argmax(y_train_clean, axis=1)[...,np.newaxis]
+                y_train_lda2 = y_train_clean
                 w_noise,c_noise = train_lda(x_train_lda2,y_train_lda2)
                 acc_all[latent_i,i] = eval_lda(w_noise, c_noise, x_test_lda, y_test_lda)
                 acc_noise[latent_i,i] = eval_lda(w_noise, c_noise, x_test_lda[clean_size:,:], y_test_lda[clean_size:,:])
@@ -1,19 +1,62 @@
 import numpy as np
-import scipy.io 
-import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 import copy as cp
 import pickle
 import os
-from datetime import date
-from tensorflow.keras.utils import to_categorical
-from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
-from sklearn.preprocessing import MinMaxScaler
-from collections import deque
+import hashlib
+import zlib
+import json
+from collections import deque, OrderedDict
 from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import time
 
+# floating point dtype of windows, augmented data, features, scalers and LDA. Keras trains in float32 anyway;
+# set_dtype(np.float64) or use_dtype(np.float64) gives the original float64 results
+DTYPE = np.float32
+
+def set_dtype(dtype):
+    # returns the previous dtype
+    global DTYPE
+    old = DTYPE
+    DTYPE = np.dtype(dtype).type
+    return old
+
+@contextmanager
+def use_dtype(dtype):
+    old = set_dtype(dtype)
+    try:
+        yield
+    finally:
+        set_dtype(old)
+
+def dtype_check(fn, *args, **kwargs):
+    # runs fn under float64 and under the current dtype and reports the largest difference between their
+    # numeric outputs (e.g. accuracies). Returns the current dtype's output, the float64 output and the difference
+    dtype = DTYPE
+    with use_dtype(np.float64):
+        ref = fn(*args, **kwargs)
+    out = fn(*args, **kwargs)
+
+    def arrays(x):
+        if isinstance(x, (list, tuple)):
+            return [a for v in x for a in arrays(v)]
+        x = np.asarray(x)
+        return [x] if x.dtype.kind in 'biuf' else []
+
+    diff = 0.0
+    for a, b in zip(arrays(out), arrays(ref)):
+        if a.shape == b.shape and a.size:
+            d = np.abs(a.astype(np.float64) - b)
+            if not np.all(np.isnan(d)):
+                diff = max(diff, float(np.nanmax(d)))
+    print(np.dtype(dtype).name + ' vs float64, max abs difference: ' + str(diff))
+    return out, ref, diff
+
+# scipy, pandas and sklearn are imported where used, importing this module for LDA-only work stays fast
 def load_raw(filename):
+    import scipy.io
     struct = scipy.io.loadmat(filename)
     daq = struct['data'][0,0]['daq']['DAQ_DATA'][0,0]
     pvd = struct['data'][0,0]['pvd']
@@ -22,6 +65,7 @@ def load_raw(filename):
 
 # params structure: [subject ID, Iter, Index, Training group, DOF, Pos]
 def load_train_data(filename):
+    import scipy.io
     struct = scipy.io.loadmat(filename)
     feat = struct['feat']
     params = struct['params']
@@ -29,35 +73,296 @@ def load_train_data(filename):
 
     return feat,params,daq
 
+def flatten_daq(daq):
+    # daq cell array to one (samples, ch) array plus [sub, grp, start, stop] rows per recording
+    data, index = [], []
+    start = 0
+    for sub in range(1,daq.shape[0]+1):
+        cells = daq[sub-1,0]
+        for grp in range(1,cells.shape[1]+1):
+            sig = np.asarray(cells[0,grp-1])
+            if sig.size == 0:
+                continue
+            data.append(sig)
+            index.append([sub, grp, start, start+sig.shape[0]])
+            start += sig.shape[0]
+    return np.concatenate(data), np.array(index, dtype=np.int64)
+
+def quantize_raw(raw, axis=1, chunk=4096):
+    # int16 copy of raw with a per-channel (axis) scale and offset, raw ~= q*scale + offset. The full
+    # channel range maps to +-32767, so the error is at most half a step. Converted chunk by chunk
+    axis = axis % raw.ndim
+    if axis == 0:
+        raise ValueError('the channel axis cannot be the row axis')
+    axes = tuple(a for a in range(raw.ndim) if a != axis)
+    lo = np.min(raw, axis=axes, keepdims=True).astype(np.float64)
+    hi = np.max(raw, axis=axes, keepdims=True).astype(np.float64)
+    offset = (hi + lo) / 2
+    scale = (hi - lo) / (2*32767)
+    scale[scale == 0] = 1.0
+
+    q = np.empty(raw.shape, dtype=np.int16)
+    for start in range(0, raw.shape[0], chunk):
+        x = (np.asarray(raw[start:start+chunk], dtype=np.float64) - offset) / scale
+        q[start:start+chunk] = np.rint(x, out=x)
+    return q, scale, offset
+
+def dequantize(q, scale, offset, out=None):
+    # q*scale + offset in DTYPE
+    if out is None:
+        out = np.empty(q.shape, dtype=DTYPE)
+    np.multiply(q, scale, out=out)
+    out += offset
+    return out
+
+class QuantizedRaw:
+    # int16 raw data that converts to DTYPE only the rows being indexed, so chunked readers
+    # (extract_feats_par, AugmentedView, train_data_split, DataStore.recording) never hold a float copy of all of it
+    def __init__(self, q, scale, offset):
+        self.q = q
+        self.scale = scale
+        self.offset = offset
+
+    @property
+    def shape(self):
+        return self.q.shape
+
+    @property
+    def ndim(self):
+        return self.q.ndim
+
+    @property
+    def dtype(self):
+        return np.dtype(DTYPE)
+
+    @property
+    def nbytes(self):
+        return self.q.nbytes
+
+    def __len__(self):
+        return self.q.shape[0]
+
+    def rows(self, ind):
+        if np.ndim(ind) == 0 and not isinstance(ind, slice):
+            return dequantize(self.q[ind], self.scale[0], self.offset[0])
+        return dequantize(self.q[ind], self.scale, self.offset)
+
+    def __getitem__(self, ind):
+        if not isinstance(ind, tuple):
+            return self.rows(ind)
+        if len(ind) == 0 or ind[0] is Ellipsis:
+            return np.asarray(self)[ind]
+        rows = self.rows(ind[0])
+        if np.ndim(ind[0]) == 0 and not isinstance(ind[0], slice):
+            return rows[ind[1:]]
+        return rows[(slice(None),) + ind[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        out = dequantize(self.q, self.scale, self.offset)
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+def save_store(arrays, folder):
+    # writes each array as folder/<name>.npy and their shapes and dtypes to folder/manifest.json
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    manifest = {}
+    for name, x in arrays.items():
+        x = np.ascontiguousarray(x)
+        np.save(folder + '/' + name + '.npy', x)
+        manifest[name] = {'shape': list(x.shape), 'dtype': x.dtype.str}
+    with open(folder + '/manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+def convert_store(filename, folder, quantize=False):
+    # one-time conversion of a train_data_raw_*.mat or train_data_raw_*.p file into a DataStore folder
+    # with quantize, the raw windows (or daq recordings) are stored as int16 plus per-channel scale and offset
+    if filename.endswith('.mat'):
+        feat, params, daq = load_train_data(filename)
+        daq_data, daq_index = flatten_daq(daq)
+        arrays = {'feat': feat, 'params': params, 'daq_data': daq_data, 'daq_index': daq_index}
+    else:
+        with open(filename,'rb') as f:
+            raw, params, feat, feat_sq = pickle.load(f)
+        arrays = {'raw': raw, 'params': params, 'feat': feat, 'feat_sq': feat_sq}
+    if quantize:
+        name = 'raw' if 'raw' in arrays else 'daq_data'
+        arrays[name], arrays[name + '_scale'], arrays[name + '_offset'] = quantize_raw(arrays[name])
+    return save_store(arrays, folder)
+
+class DataStore:
+    # Arrays of a store folder, each memory-mapped read-only on first access. Pages are only read
+    # when touched and are shared through the page cache between processes.
+    def __init__(self, folder):
+        self.folder = folder
+        with open(folder + '/manifest.json') as f:
+            self.manifest = json.load(f)
+        self.arrays = {}
+
+    def __contains__(self, name):
+        return name in self.manifest
+
+    def keys(self):
+        return self.manifest.keys()
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            if name not in self.manifest:
+                raise KeyError(name)
+            x = np.load(self.folder + '/' + name + '.npy', mmap_mode='r')
+            # quantized arrays stay int16 in the page cache and convert on access
+            if name + '_scale' in self.manifest:
+                x = QuantizedRaw(x, np.load(self.folder + '/' + name + '_scale.npy'), np.load(self.folder + '/' + name + '_offset.npy'))
+            self.arrays[name] = x
+        return self.arrays[name]
+
+    def recording(self, sub, grp):
+        # continuous (samples, ch) recording of one subject and group, as a memory-mapped slice
+        index = self['daq_index']
+        row = np.nonzero((index[:,0] == sub) & (index[:,1] == grp))[0]
+        if row.shape[0] == 0:
+            raise KeyError((sub, grp))
+        data = self['daq_data']
+        if isinstance(data, QuantizedRaw):
+            return QuantizedRaw(data.q[index[row[0],2]:index[row[0],3]], data.scale, data.offset)
+        return data[index[row[0],2]:index[row[0],3]]
+
+    def daq(self):
+        # nested cell layout of load_train_data's daq, filled with memory-mapped recordings
+        index = self['daq_index']
+        daq = np.empty((int(index[:,0].max()),1), dtype=object)
+        for sub in range(1,daq.shape[0]+1):
+            daq[sub-1,0] = np.empty((1,int(index[:,1].max())), dtype=object)
+            for grp in range(1,daq[sub-1,0].shape[1]+1):
+                in_store = ((index[:,0] == sub) & (index[:,1] == grp)).any()
+                daq[sub-1,0][0,grp-1] = self.recording(sub, grp) if in_store else np.zeros((0,0))
+        return daq
+
+def daq_windows(sig, win=200, hop=1):
+    # zero-copy (n, ch, win) view of the windows of a continuous (samples, ch) recording every hop samples
+    return sliding_window_view(sig, win, axis=0)[::hop]
+
+def window_daq(daq, params, win=200, ch=6, dtype=None):
+    # (n, ch, win) window for every params row, gathered per (subject, group) recording of the daq cells
+    out = np.empty((params.shape[0], ch, win), dtype=DTYPE if dtype is None else dtype)
+    rec, rec_i = np.unique(params[:,0:2], axis=0, return_inverse=True)
+    rec_i = rec_i.ravel()
+    for k in range(rec.shape[0]):
+        rows = np.nonzero(rec_i == k)[0]
+        sub, grp = rec[k]
+        windows = daq_windows(np.asarray(daq[sub-1,0][0,grp-1])[:,:ch], win)
+        ind = params[rows,2] - 1
+
+        # regularly spaced windows are a strided view, anything else a gather
+        step = ind[1] - ind[0] if ind.shape[0] > 1 else 1
+        if step > 0 and np.all(np.diff(ind) == step):
+            out[rows] = windows[ind[0]:ind[-1]+1:step]
+        else:
+            out[rows] = windows[ind]
+    return out
+
 def process_daq(daq,params,win=200,ch=6):
-    trial_data = np.zeros((win,6,params.shape[0]))
-    for trial in range(0,params.shape[0]-1):
-        sub = params[trial,0]
-        grp = params[trial,1]
-        ind = params[trial,2]
-        trial_data[:,:,trial] = daq[sub-1,0][0,grp-1][ind-1:ind+win-1,:]
-    
-    return trial_data
+    # (win, ch, trials) layout, see window_daq for (trials, ch, win)
+    return np.transpose(window_daq(daq, params, win, ch), (2,1,0))
+
+# params columns by name
+PARAMS_COLS = {'sub': 0, 'rep': 1, 'ind': 2, 'grp': 3, 'class': 4, 'pos': 5, 'cv': 6}
+
+def compact_int(x):
+    # smallest signed integer dtype that holds x
+    for dtype in (np.int8, np.int16, np.int32):
+        if x.size == 0 or (x.min() >= np.iinfo(dtype).min and x.max() <= np.iinfo(dtype).max):
+            return x.astype(dtype)
+    return x.astype(np.int64)
+
+class ParamsIndex:
+    # params sorted once by keys, with offsets for every key prefix so that selecting e.g. (sub, grp)
+    # or (sub, grp, class) is a contiguous slice. Data sorted with sort() can then be sliced without
+    # copies. Columns are stored in compact integer dtypes, and digest identifies the params it was built on.
+    def __init__(self, params, keys=('sub', 'grp', 'class', 'rep')):
+        self.keys = tuple(keys)
+        self.digest = params_digest(params)
+        key_cols = [PARAMS_COLS[k] for k in self.keys]
+        self.order = np.lexsort(params[:,key_cols[::-1]].T)
+        params_sorted = params[self.order]
+        self.cols = {name: compact_int(params_sorted[:,c]) for name, c in PARAMS_COLS.items() if c < params.shape[1]}
+
+        n = params_sorted.shape[0]
+        self.offsets = {}
+        change = np.zeros(n, dtype=bool)
+        change[:1] = True
+        for level in range(len(key_cols)):
+            change[1:] |= params_sorted[1:,key_cols[level]] != params_sorted[:-1,key_cols[level]]
+            starts = np.nonzero(change)[0]
+            stops = np.append(starts[1:], n)
+            key_vals = params_sorted[starts][:,key_cols[:level+1]]
+            for k in range(starts.shape[0]):
+                self.offsets[tuple(key_vals[k].tolist())] = (int(starts[k]), int(stops[k]))
+
+    def __len__(self):
+        return self.order.shape[0]
+
+    def slice(self, *key):
+        # slice into sorted order for a prefix of keys, empty if there are no such rows
+        start, stop = self.offsets.get(tuple(int(k) for k in key), (0, 0))
+        return slice(start, stop)
+
+    def rows(self, *key):
+        # original row numbers of the selection
+        return self.order[self.slice(*key)]
+
+    def sort(self, x):
+        # x (rows aligned with the original params) in sorted order, one copy
+        return x[self.order]
+
+    def take(self, x_sorted, *key):
+        # zero-copy selection from data already in sorted order
+        return x_sorted[self.slice(*key)]
+
+    def col(self, name, *key):
+        return self.cols[name][self.slice(*key)]
 
 def process_df(params):
+    import pandas as pd
     df = pd.DataFrame(data=params,columns=['sub','trial','ind','group','class','pos'])
     df = df.set_index('sub')
     
     return df
 
-def sub_train_test(feat,params,sub,train_grp,test_grp):
+def class_labels(cls):
+    # zero-based class labels as a compact integer (n, 1) column, for LDA and sparse categorical losses
+    return compact_int(np.asarray(cls) - 1)[...,np.newaxis]
+
+def one_hot(y, n_class=None, dtype=np.float32):
+    # to_categorical without tensorflow, for callers that still need one-hot labels
+    y = np.asarray(y).reshape(-1)
+    if n_class is None:
+        n_class = int(np.max(y)) + 1
+    out = np.zeros((y.shape[0], n_class), dtype=dtype)
+    out[np.arange(y.shape[0]), y] = 1
+    return out
+
+def sub_rows(params, sub, grp, pidx=None):
+    # ascending row numbers of one subject and group; with a ParamsIndex (keyed sub, grp first) this is
+    # a lookup instead of a scan of params
+    if pidx is None:
+        return np.nonzero((params[:,0] == sub) & (params[:,3] == grp))[0]
+    return np.sort(pidx.rows(sub, grp))
+
+def sub_train_test(feat,params,sub,train_grp,test_grp,pidx=None):
     # Index EMG data
-    x_train, y_train = sub_split(feat, params, sub, train_grp)
-    x_test, y_test = sub_split(feat, params, sub, test_grp)
+    x_train, y_train = sub_split(feat, params, sub, train_grp, pidx)
+    x_test, y_test = sub_split(feat, params, sub, test_grp, pidx)
 
     return x_train, y_train, x_test, y_test
 
-def sub_split(feat, params, sub, grp):
-    ind = (params[:,0] == sub) & (params[:,3] == grp)
+def sub_split(feat, params, sub, grp, pidx=None):
+    from sklearn.utils import shuffle
+    ind = sub_rows(params, sub, grp, pidx)
     
-    if np.sum(ind):
+    if ind.size:
         if feat.ndim == 3:
-            x, y = shuffle(feat[ind,:,:],to_categorical(params[ind,-2]-1))
+            x, y = shuffle(feat[ind,:,:],class_labels(params[ind,-2]))
             # Add dimension to x data to fit CNN architecture
             x = x[...,np.newaxis]
         else:
@@ -68,12 +373,14 @@ def sub_split(feat, params, sub, grp):
         y = 0
     return x,y
 
-def sub_split_stat(feat, params, sub, grp):
-    ind = (params[:,0] == sub) & (params[:,3] == grp) & (params[:,5] == 1)
+def sub_split_stat(feat, params, sub, grp, pidx=None):
+    from sklearn.utils import shuffle
+    ind = sub_rows(params, sub, grp, pidx)
+    ind = ind[params[ind,5] == 1]
 
-    if np.sum(ind):
+    if ind.size:
         if feat.ndim == 3:
-            x, y = shuffle(feat[ind,:,:],to_categorical(params[ind,-2]-1))
+            x, y = shuffle(feat[ind,:,:],class_labels(params[ind,-2]))
             # Add dimension to x data to fit CNN architecture
             x = x[...,np.newaxis]
         else:
@@ -84,12 +391,13 @@ def sub_split_stat(feat, params, sub, grp):
         y = 0
     return x,y
 
-def sub_split_loo(feat, params, sub, grp):
-    ind = (params[:,0] == sub) & (params[:,3] == 4)
+def sub_split_loo(feat, params, sub, grp, pidx=None):
+    from sklearn.utils import shuffle
+    ind = sub_rows(params, sub, 4, pidx)
     
-    if np.sum(ind):
+    if ind.size:
         if feat.ndim == 3:
-            x, y = shuffle(feat[ind,:,:],to_categorical(params[ind,-2]-1))
+            x, y = shuffle(feat[ind,:,:],class_labels(params[ind,-2]))
             # Add dimension to x data to fit CNN architecture
             x = x[...,np.newaxis]
         else:
@@ -100,192 +408,493 @@ def sub_split_loo(feat, params, sub, grp):
         y = 0
     return x,y
 
-def train_data_split(raw, params, sub, sub_type, dt=0, train_grp=2, load=True, test_i = 5, valid_i = 4):
-    if dt == 0:
-        today = date.today()
-        dt = today.strftime("%m%d")
-    # foldername = 'models' + '_' + str(train_grp) + '_' + dt
-    foldername = 'traindata_' + dt
-    filename = foldername + '/' + sub_type + str(sub) + '_traindata_' + str(train_grp)  + '.p'
-    if not os.path.isdir(foldername):
-        os.mkdir(foldername)
-    if load:
-        if os.path.isfile(filename):
-            with open(filename,'rb') as f:
-                x_train, x_test, x_valid, p_train, p_test, p_valid = pickle.load(f)
-                
-                if train_grp < 3:
-                    x_train, p_train = shuffle(x_train, p_train, random_state = 0)
-                    x_test, p_test = shuffle(x_test, p_test, random_state = 0)
-                    x_valid, p_valid = shuffle(x_valid, p_valid, random_state = 0)
-        else:
-            load=False
-    if not load:
-        ind = (params[:,0] == sub) & (params[:,3] == train_grp)
-        if train_grp > 2:
-            x_train, x_valid, p_train, p_valid = 0,0,0,0
-            x_test, p_test = raw[ind,:,:], params[ind,:] 
-        else:
-            if dt == 'cv':
-                train_ind = ind & (params[:,6] != test_i)
-                test_ind = ind & (params[:,6] == test_i)
-                x_train, p_train = raw[train_ind,:,:], params[train_ind,:]
-                x_valid, p_valid = raw[train_ind,:,:], params[train_ind,:]
-                x_test, p_test = raw[test_ind,:,:], params[test_ind,:]
-            elif dt == 'manual':
-                train_ind = ind & (params[:,6] != test_i) & (params[:,6] != valid_i)
-                valid_ind = ind & (params[:,6] == valid_i)
-                test_ind = ind & (params[:,6] == test_i)
-                x_train, p_train = raw[train_ind,:,:], params[train_ind,:]
-                x_valid, p_valid = raw[valid_ind,:,:], params[valid_ind,:]
-                x_test, p_test = raw[test_ind,:,:], params[test_ind,:]
-            else:
-                # Split training and testing data
-                x_temp, x_test, p_temp, p_test = train_test_split(raw[ind,:,:], params[ind,:], test_size = 0.2, stratify=params[ind,4], shuffle=True)
-                x_train, x_valid, p_train, p_valid = train_test_split(x_temp, p_temp, test_size = 0.33, stratify=p_temp[:,4], shuffle=True)
-        
-        with open(filename, 'wb') as f:
-            pickle.dump([x_train, x_test, x_valid, p_train, p_test, p_valid],f)
+def split_rows(params, sub, train_grp=2, mode='rand', test_i=5, valid_i=4, seed=0, pidx=None):
+    # train, test and valid row indices into params for one subject and training group
+    ind = sub_rows(params, sub, train_grp, pidx)
+    empty = np.zeros(0, dtype=ind.dtype)
+    if train_grp > 2:
+        return empty, ind, empty
+
+    if mode == 'cv':
+        train = ind[params[ind,6] != test_i]
+        return train, ind[params[ind,6] == test_i], train
+    elif mode == 'manual':
+        train = ind[(params[ind,6] != test_i) & (params[ind,6] != valid_i)]
+        return train, ind[params[ind,6] == test_i], ind[params[ind,6] == valid_i]
+
+    # Split training and testing data
+    from sklearn.model_selection import train_test_split
+    temp, test = train_test_split(ind, test_size = 0.2, stratify=params[ind,4], shuffle=True, random_state=seed)
+    train, valid = train_test_split(temp, test_size = 0.33, stratify=params[temp,4], shuffle=True, random_state=seed)
+    return train, test, valid
+
+def split_folds(params, rows, cv):
+    # (training, held out) rows of a split for cv fold cv, from the fold column params[:,6]
+    return rows[params[rows,6] != cv], rows[params[rows,6] == cv]
 
-        if train_grp < 3:
-            x_train, p_train = shuffle(x_train, p_train, random_state = 0)
-            x_test, p_test = shuffle(x_test, p_test, random_state = 0)
-            x_valid, p_valid = shuffle(x_valid, p_valid, random_state = 0)
+def params_digest(params, cols=(0, 3, 4, 6)):
+    # content hash of the params columns a split reads (sub, grp, class, cv), in row order
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(params.shape[0]).encode())
+    h.update(np.ascontiguousarray(params[:,list(cols)], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def split_seed(dt, seed=None):
+    # random splits of a dated run (dt e.g. '0414') are drawn from a seed derived from dt, so models saved
+    # under that run's folder are always tested on their own split
+    if seed is not None:
+        return seed
+    if dt == 0 or dt in ('cv', 'manual'):
+        return 0
+    return zlib.crc32(str(dt).encode())
+
+def legacy_split(filename, params, sub, train_grp=2, pidx=None):
+    # row indices of a split that earlier versions pickled as arrays (x_train, x_test, x_valid, p_train,
+    # p_test, p_valid), found by matching its params rows against params and kept in pickle order
+    with open(filename, 'rb') as f:
+        split = pickle.load(f)
+    lookup = {}
+    for r in sub_rows(params, sub, train_grp, pidx):
+        key = tuple(params[r].tolist())
+        lookup[key] = -1 if key in lookup else r
+
+    out = []
+    for p in split[3:]:
+        if np.ndim(p) != 2:
+            out.append(np.zeros(0, dtype=np.intp))
+            continue
+        rows = np.array([lookup.get(tuple(row), -1) for row in np.asarray(p).tolist()], dtype=np.intp)
+        if np.any(rows < 0):
+            raise ValueError(filename + ' does not match params: ' + str(int(np.sum(rows < 0))) + ' rows are missing or ambiguous, '
+                'so the models trained on it cannot be tested on a known split')
+        out.append(rows)
+    return tuple(out)
+
+def split_index(params, sub, sub_type, train_grp=2, mode='rand', test_i=5, valid_i=4, seed=0, load=True, folder='splits', pidx=None, legacy=None):
+    # split_rows stored as a small .npz of row indices, keyed by everything that defines the split;
+    # the stored params digest makes a reordered or regenerated params recompute the split. With load,
+    # a legacy pickled split (see legacy_split) is converted to row indices once instead of drawing a new one
+    filename = folder + '/' + sub_type + str(sub) + '_' + str(train_grp) + '_' + mode + '_' + str(test_i) + '_' + str(valid_i) + '_' + str(seed) + '.npz'
+    digest = params_digest(params) if pidx is None else pidx.digest
+    if load and os.path.isfile(filename):
+        with np.load(filename) as f:
+            if 'digest' in f and str(f['digest']) == digest:
+                return f['train'], f['test'], f['valid']
+
+    if load and legacy is not None and os.path.isfile(legacy):
+        train, test, valid = legacy_split(legacy, params, sub, train_grp, pidx)
+    else:
+        train, test, valid = split_rows(params, sub, train_grp, mode, test_i, valid_i, seed, pidx)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    np.savez(filename, train=train, test=test, valid=valid, n=params.shape[0], digest=digest)
+    return train, test, valid
+
+def train_data_split(raw, params, sub, sub_type, dt=0, train_grp=2, load=True, test_i = 5, valid_i = 4, seed=None, pidx=None):
+    # dt selects the split mode ('cv', 'manual', anything else is a random split, by default seeded from dt);
+    # only row indices are stored and the data is gathered from raw on every call. A dated run's
+    # traindata_<dt> pickle from earlier versions is reused, so its saved models keep their split
+    mode = dt if dt in ('cv', 'manual') else 'rand'
+    legacy = None
+    if mode == 'rand' and dt != 0:
+        legacy = 'traindata_' + str(dt) + '/' + sub_type + str(sub) + '_traindata_' + str(train_grp) + '.p'
+    train, test, valid = split_index(params, sub, sub_type, train_grp, mode, test_i, valid_i, split_seed(dt, seed), load, pidx=pidx, legacy=legacy)
+
+    if train_grp < 3:
+        from sklearn.utils import shuffle
+        train = shuffle(train, random_state = 0)
+        test = shuffle(test, random_state = 0)
+        valid = shuffle(valid, random_state = 0)
+
+    x_test, p_test = raw[test,...], params[test,:]
+    if train_grp > 2:
+        x_train, x_valid, p_train, p_valid = 0,0,0,0
+    else:
+        x_train, p_train = raw[train,...], params[train,:]
+        x_valid, p_valid = raw[valid,...], params[valid,:]
     return x_train, x_test, x_valid, p_train, p_test, p_valid
 
+def minmax_scale(data_min, data_max, feature_range=(-1,1)):
+    # [scale_, min_] as MinMaxScaler computes them, near constant features get a scale of 1
+    data_range = data_max - data_min
+    data_range[data_range < 10 * np.finfo(data_range.dtype).eps] = 1.0
+    scale = (feature_range[1] - feature_range[0]) / data_range
+    return np.stack((scale, feature_range[0] - data_min * scale), axis=-2)
+
+def minmax_params(scaler):
+    # scaler array from minmax_fit, or from a fitted sklearn MinMaxScaler (e.g. older pickles)
+    if hasattr(scaler, 'scale_'):
+        return np.stack((scaler.scale_, scaler.min_))
+    return np.asarray(scaler)
+
+def feat_axis(shape, n_feat):
+    # first of the trailing axes that together hold the n_feat columns of x.reshape(-1, n_feat)
+    for k in range(len(shape), -1, -1):
+        if int(np.prod(shape[k:])) == n_feat:
+            return k
+        if int(np.prod(shape[k:])) > n_feat:
+            break
+    raise ValueError('n_feat must be the size of trailing axes of x')
+
+def minmax_fit(x, n_feat=None, feature_range=(-1,1)):
+    # MinMaxScaler(feature_range).fit(x.reshape(-1, n_feat)) as a (2, n_feat) array [scale_, min_]
+    if n_feat is None:
+        n_feat = x.shape[-1]
+    k = feat_axis(x.shape, n_feat)
+    # reducing the row axis first is much faster on transposed views, fmin/fmax skip nans like nanmin
+    data_min, data_max = x, x
+    if k > 0:
+        data_min, data_max = np.fmin.reduce(x, axis=0), np.fmax.reduce(x, axis=0)
+    if k > 1:
+        data_min = np.fmin.reduce(data_min, axis=tuple(range(k-1)))
+        data_max = np.fmax.reduce(data_max, axis=tuple(range(k-1)))
+    return minmax_scale(data_min.reshape(-1), data_max.reshape(-1), feature_range)
+
+def minmax_apply(x, scaler, n_feat=None, out=None):
+    # scaler.transform on x.reshape(-1, n_feat) without reshaping x, written to out (out=x for in place)
+    scaler = minmax_params(scaler)
+    if n_feat is None:
+        n_feat = scaler.shape[-1]
+    k = feat_axis(x.shape, n_feat)
+    if out is None:
+        out = np.empty(x.shape, dtype=DTYPE)
+    np.multiply(x, scaler[0].reshape(x.shape[k:]), out=out)
+    out += scaler[1].reshape(x.shape[k:])
+    return out
+
+def minmax_fit_groups(x, groups, n_feat=None, feature_range=(-1,1)):
+    # minmax_fit separately for the rows of x in each group, in one pass. Returns the sorted group ids
+    # and a (n_groups, 2, n_feat) scaler array
+    if n_feat is None:
+        n_feat = int(np.prod(x.shape[1:]))
+    k = max(feat_axis(x.shape, n_feat), 1)
+    row_min = np.fmin.reduce(x, axis=tuple(range(1,k))).reshape(x.shape[0], n_feat)
+    row_max = np.fmax.reduce(x, axis=tuple(range(1,k))).reshape(x.shape[0], n_feat)
+    order = np.argsort(groups, kind='stable')
+    ids, starts = np.unique(groups[order], return_index=True)
+    data_min = np.fmin.reduceat(row_min[order], starts, axis=0)
+    data_max = np.fmax.reduceat(row_max[order], starts, axis=0)
+    return ids, minmax_scale(data_min, data_max, feature_range)
+
+def minmax_apply_groups(x, ids, scaler, groups, out=None):
+    # minmax_apply with each row's scaler looked up by its group, out=x for in place
+    n_feat = scaler.shape[-1]
+    k = max(feat_axis(x.shape, n_feat), 1)
+    if out is None:
+        out = np.empty(x.shape, dtype=DTYPE)
+    g = np.searchsorted(ids, groups)
+    shape = (x.shape[0],) + (1,) * (k - 1) + x.shape[k:]
+    np.multiply(x, scaler[g,0,:].reshape(shape), out=out)
+    out += scaler[g,1,:].reshape(shape)
+    return out
+
 def norm_sub(feat, params):
-    for sub in range(1,np.max(params[:,0])):
-        ind = params[:,0] == sub
-        scaler = MinMaxScaler(feature_range=(-1,1))
-        feat_out = feat[ind,:,:]
-        feat[ind,:,:] = scaler.fit_transform(feat_out.reshape(feat_out.shape[0],-1)).reshape(feat_out.shape)
-    
-    return feat
+    # scale each subject's features to [-1, 1], in place
+    ids, scaler = minmax_fit_groups(feat, params[:,0])
+    return minmax_apply_groups(feat, ids, scaler, params[:,0], out=feat)
 
-def remove_ch(raw, params, sub, n_type='flat', scale=5):
-    # Index subject and training group
-    max_ch = raw.shape[1] + 1
+def ch_bits_mask(ch_bits, n_ch=6):
+    # per-row channel bitmask (bit i set = channel i kept) to a boolean (rows, ch) mask
+    return ((np.asarray(ch_bits)[...,np.newaxis] >> np.arange(n_ch)) & 1).astype(bool)
+
+def remove_ch_mask(raw, params, sub, n_type='flat'):
+    # Channel-removal layout of remove_ch without copying raw: a bitmask per row of the tiled data,
+    # where row r is raw[r % n], and integer labels for the same rows
+    n, n_ch = raw.shape[0], raw.shape[1]
     num_ch = int(n_type[-1]) + 1
-    out = cp.deepcopy(raw)
     full_type = n_type[0:4]
     noise_type = n_type[4:-1]
 
-    # tile data once for each channel
     if full_type == 'full':
         start_ch = 1
-        sub_params = np.tile(params,(num_ch,1))
-        orig = np.tile(raw,(num_ch,1,1))
-    # tile data twice, once for clean and once for noise
     elif full_type == 'part':
         start_ch = num_ch - 1
-        sub_params = np.tile(params,(2,1))
-        orig = np.tile(raw,(2,1,1))
-
-    # loop through channel noise
-    for num_noise in range(start_ch,num_ch):
-        ch_all = list(combinations(range(0,6),num_noise))
-        temp = cp.deepcopy(raw)
-        if noise_type == 'gaussflat':
-            ch_split = temp.shape[0]//(3*len(ch_all))
-        else:
-            ch_split = temp.shape[0]//len(ch_all)
+    else:
+        raise ValueError('unknown noise type: ' + str(n_type))
+
+    all_bits = (1 << n_ch) - 1
+    ch_bits = np.full((1+num_ch-start_ch)*n, all_bits, dtype=np.min_scalar_type(all_bits))
+    seg = 3 if noise_type == 'gaussflat' else 1
+
+    # loop through channel noise, one block per number of removed channels
+    for b, num_noise in enumerate(range(start_ch,num_ch)):
+        if noise_type not in ('gaussflat', 'gauss', 'flat'):
+            continue
+        ch_all = list(combinations(range(0,n_ch),num_noise))
+        ch_split = n//(seg*len(ch_all))
+        block = ch_bits[(b+1)*n:(b+2)*n]
         for ch in range(0,len(ch_all)):
-            for i in ch_all[ch]:
-                # if full_type == 'part':
-                #     temp = cp.deepcopy(raw)
-                # temp[:,i,:] += np.random.normal(0,scale,temp.shape[2])
-                if noise_type == 'gaussflat':
-                    # if ch == 0:
-                    #     print('gaussflat:' + str(ch_split))
-                    temp[3*ch*ch_split:(3*ch+1)*ch_split,i,:] = np.nan
-                    temp[(3*ch+1)*ch_split:(3*ch+2)*ch_split,i,:] = np.nan
-                    temp[(3*ch+2)*ch_split:(3*ch+3)*ch_split,i,:] = np.nan
-                elif noise_type == 'gauss':
-                    # if ch == 0:
-                    #     print('gauss:' + str(ch_split))
-                    temp[ch*ch_split:(ch+1)*ch_split,i,:] = np.nan
-                    # temp[:,i,:] += np.random.normal(0,scale,temp.shape[2])
-                elif noise_type == 'flat':
-                    # if ch == 0:
-                    #     print('flat:' + str(ch_split))
-                    temp[ch*ch_split:(ch+1)*ch_split,i,:] = np.nan
-                    # temp[:,i,:] = 0
-                # if full_type == 'part':
-                #     out = np.concatenate((out,temp))
-        # if full_type == 'full':
-        out = np.concatenate((out,temp))
-        
+            block[seg*ch*ch_split:seg*(ch+1)*ch_split] &= all_bits ^ sum(1 << i for i in ch_all[ch])
+
+    y = compact_int(np.tile(params[:,-2], ch_bits.shape[0]//n) - 1)
+    return ch_bits, y
 
-    noisy, clean, y = out, orig, to_categorical(sub_params[:,-2]-1)
+def remove_ch(raw, params, sub, n_type='flat', scale=5):
+    # materialised version of remove_ch_mask, removed channels are NaN
+    ch_bits, y = remove_ch_mask(raw, params, sub, n_type)
+    clean = np.tile(raw,(ch_bits.shape[0]//raw.shape[0],1,1))
+    noisy = clean.copy()
+    noisy[~ch_bits_mask(ch_bits, raw.shape[1])] = np.nan
 
     clean = clean[...,np.newaxis]
     noisy = noisy[...,np.newaxis]
-    return noisy,clean,y
+    return noisy,clean,y[...,np.newaxis]
 
-def add_noise(raw, params, sub, n_type='flat', scale=5):
-    # Index subject and training group
-    max_ch = raw.shape[1] + 1
+def extract_feats_mask(raw, ch_bits, th=0.01, layout='flat', fill=np.nan):
+    # features of the rows described by ch_bits (row r is raw[r % n]), computed once on the clean
+    # data; removed channels are skipped and their features set to fill
+    if raw.shape[-1] == 1:
+        raw = raw[...,0]
+    n, n_ch = raw.shape[0], raw.shape[1]
+    out = extract_feats(raw, th, layout=layout)[np.arange(ch_bits.shape[0]) % n]
+    feat = feat_view(out, out.shape[0], n_ch, layout)
+    np.moveaxis(feat, 1, 2)[~ch_bits_mask(ch_bits, n_ch)] = fill
+    return out
+
+# noise plan ops
+NOISE_FLAT = 0
+NOISE_GAUSS = 1
+NOISE_60HZ = 2
+
+def noise_plan(n, n_type='flat', scale=5, n_ch=6):
+    # Corruption plan for add_noise as flat segment arrays. Block b fills rows (b+1)*n + [start, stop)
+    # of the noisy output, ops are applied to the channels in mask. Segments are kept in the order the
+    # original loops drew their noise, including empty ones, so the random streams line up.
     num_ch = int(n_type[-1]) + 1
     full_type = n_type[0:4]
     noise_type = n_type[4:-1]
 
     if noise_type == 'gaussflat':
         rep = 2
+        ops = [[(NOISE_FLAT, 0), (NOISE_GAUSS, 1), (NOISE_GAUSS, 2)], [(NOISE_GAUSS, 3), (NOISE_GAUSS, 4), (NOISE_GAUSS, 5)]]
     else:
         rep = 1
-    
-    # tile data once for each channel
+        ops = {'gauss': [[(NOISE_GAUSS, scale)]], 'flat': [[(NOISE_FLAT, 0)]], '60hz': [[(NOISE_60HZ, scale)]]}.get(noise_type, [[]])
+
     if full_type == 'full':
         start_ch = 1
-        sub_params = np.tile(params,(rep*(num_ch-1)+1,1))
-        orig = np.tile(raw,(rep*(num_ch-1),1,1))
-    # tile data twice, once for clean and once for noise
     elif full_type == 'part':
         start_ch = num_ch - 1
-        sub_params = np.tile(params,(2,1))
-        orig = np.tile(raw,(2,1,1))
-        
-    out = np.array([]).reshape(0,6,200)
-    for rep_i in range(rep):   
-        # loop through channel noise
-        for num_noise in range(start_ch,num_ch):
-            ch_all = list(combinations(range(0,6),num_noise))
-            temp = cp.deepcopy(raw)
+    else:
+        raise ValueError('unknown noise type: ' + str(n_type))
+
+    block, combo, start, stop, mask, op, op_scale = [], [], [], [], [], [], []
+    b = 0
+    combo_i = 0
+    for rep_i in range(rep):
+        for num_noise in range(start_ch, num_ch):
+            ch_all = list(combinations(range(0,n_ch), num_noise))
             if full_type == 'full':
-                ch_split = temp.shape[0]//(3*len(ch_all))
+                ch_split = n//(3*len(ch_all))
             else:
-                ch_split = temp.shape[0]//len(ch_all)
+                ch_split = n//len(ch_all)
+            seg_ops = ops[rep_i]
             for ch in range(0,len(ch_all)):
-                for i in ch_all[ch]:
-                    if noise_type == 'gaussflat':
-                        if rep_i == 0:
-                            temp[3*ch*ch_split:(3*ch+1)*ch_split,i,:] = 0
-                            temp[(3*ch+1)*ch_split:(3*ch+2)*ch_split,i,:] += np.random.normal(0,1,temp.shape[2])
-                            temp[(3*ch+2)*ch_split:(3*ch+3)*ch_split,i,:] += np.random.normal(0,2,temp.shape[2])
-                        else:
-                            temp[3*ch*ch_split:(3*ch+1)*ch_split,i,:] += np.random.normal(0,3,temp.shape[2])
-                            temp[(3*ch+1)*ch_split:(3*ch+2)*ch_split,i,:] += np.random.normal(0,4,temp.shape[2])
-                            temp[(3*ch+2)*ch_split:(3*ch+3)*ch_split,i,:] += np.random.normal(0,5,temp.shape[2])
-                            # temp[ch*ch_split:(ch+1)*ch_split,i,:] += np.random.normal(0,rep_i,temp.shape[2])
-                    elif noise_type == 'gauss':
-                        temp[ch*ch_split:(ch+1)*ch_split,i,:] += np.random.normal(0,scale,temp.shape[2])
-                    elif noise_type == 'flat':
-                        temp[ch*ch_split:(ch+1)*ch_split,i,:] = 0
-                    elif noise_type == '60hz':
-                        x = np.linspace(0,temp.shape[2],temp.shape[2])
-                        temp[ch*ch_split:(ch+1)*ch_split,i,:] += scale*np.sin(2*np.pi*60*x)
+                ch_mask = np.zeros(n_ch, dtype=bool)
+                ch_mask[list(ch_all[ch])] = True
+                for k in range(len(seg_ops)):
+                    seg = len(seg_ops)*ch + k
+                    block.append(b)
+                    combo.append(combo_i)
+                    start.append(min(seg*ch_split, n))
+                    stop.append(min((seg+1)*ch_split, n))
+                    mask.append(ch_mask)
+                    op.append(seg_ops[k][0])
+                    op_scale.append(seg_ops[k][1])
+                combo_i += 1
+            b += 1
 
-            out = np.concatenate((out,temp))
-    
-    out = np.concatenate((raw, out))
-    orig = np.concatenate((raw, orig))
+    return {'n': n, 'n_ch': n_ch, 'n_blocks': b, 'block': np.array(block, dtype=int), 'combo': np.array(combo, dtype=int),
+            'start': np.array(start, dtype=int), 'stop': np.array(stop, dtype=int), 'mask': np.array(mask, dtype=bool).reshape(-1,n_ch),
+            'op': np.array(op, dtype=int), 'scale': np.array(op_scale, dtype=np.float64)}
 
-    noisy, clean, y = out, orig, to_categorical(sub_params[:,4]-1)
+def noise_rng(seed, sub, split, n_type, scale, block):
+    # counter-based Philox stream for one block of augmented data, identical in any process
+    key = repr((int(seed), int(sub), str(split), str(n_type), float(scale), int(block)))
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    return np.random.Generator(np.random.Philox(key=int.from_bytes(digest, 'little')))
+
+def plan_noise(plan, win, rng=None, key=None, blocks=None):
+    # additive noise of every segment as (segments, ch, win), zero on channels that are not added to
+    # key = (seed, sub, split, n_type, scale) draws each block from its own noise_rng stream,
+    # otherwise everything comes from rng (np.random by default) in one call
+    noise = np.zeros((plan['op'].shape[0], plan['n_ch'], win))
+    seg_all, ch_all = np.nonzero(plan['mask'] & (plan['op'] == NOISE_GAUSS)[:,np.newaxis])
+    if blocks is not None:
+        keep = np.isin(plan['block'][seg_all], blocks)
+        seg_all, ch_all = seg_all[keep], ch_all[keep]
+
+    # gaussian (segment, channel) pairs in the original combo, channel, segment order
+    order = np.lexsort((seg_all, ch_all, plan['combo'][seg_all]))
+    seg_all, ch_all = seg_all[order], ch_all[order]
+    if key is None:
+        if rng is None:
+            rng = np.random
+        noise[seg_all,ch_all,:] = rng.normal(0, plan['scale'][seg_all,np.newaxis], (seg_all.shape[0], win))
+    else:
+        for b in np.unique(plan['block'][seg_all]):
+            ind = plan['block'][seg_all] == b
+            seg, ch = seg_all[ind], ch_all[ind]
+            noise[seg,ch,:] = noise_rng(*key, b).normal(0, plan['scale'][seg,np.newaxis], (seg.shape[0], win))
+
+    seg, ch = np.nonzero(plan['mask'] & (plan['op'] == NOISE_60HZ)[:,np.newaxis])
+    if blocks is not None:
+        keep = np.isin(plan['block'][seg], blocks)
+        seg, ch = seg[keep], ch[keep]
+    x = np.linspace(0,win,win)
+    noise[seg,ch,:] = plan['scale'][seg,np.newaxis]*np.sin(2*np.pi*60*x)
+    return noise
+
+def fill_segments(out, plan, noise, segs, row0):
+    # applies the plan segments segs to out, whose row 0 is row0 of block-relative rows
+    for s in segs:
+        seg = out[row0[s]+plan['start'][s]:row0[s]+plan['stop'][s]]
+        where = plan['mask'][s,:,np.newaxis]
+        if plan['op'][s] == NOISE_FLAT:
+            np.copyto(seg, 0, where=where)
+        else:
+            np.add(seg, noise[s], out=seg, where=where)
+
+def apply_noise_plan(raw, plan, out=None, noise=None, rng=None, key=None):
+    # raw followed by one corrupted copy per block, filled in place in a single preallocated array
+    n, n_ch, win = raw.shape
+    if out is None:
+        out = np.empty(((plan['n_blocks']+1)*n, n_ch, win), dtype=DTYPE)
+    out.reshape(plan['n_blocks']+1, n, n_ch, win)[:] = raw
+    if noise is None:
+        noise = plan_noise(plan, win, rng, key)
+    fill_segments(out, plan, noise, range(plan['op'].shape[0]), (plan['block']+1)*n)
+    return out
+
+def noise_block(raw, plan, block, key=None, noise=None):
+    # regenerates corrupted block number block on its own, identical to the same rows of apply_noise_plan
+    out = np.array(raw, dtype=DTYPE)
+    if noise is None:
+        noise = plan_noise(plan, raw.shape[2], key=key, blocks=[block])
+    fill_segments(out, plan, noise, np.nonzero(plan['block'] == block)[0], np.zeros_like(plan['block']))
+    return out
+
+def add_noise(raw, params, sub, n_type='flat', scale=5, seed=None, split='train', return_plan=False):
+    # with a seed, noise comes from counter-based streams keyed by (seed, sub, split, n_type, scale, block)
+    # so the augmented data can be regenerated anywhere instead of stored. return_plan also returns
+    # (plan, noise table), e.g. for noise_feats of the noisy rows
+    raw = np.asarray(raw, dtype=DTYPE)
+    plan = noise_plan(raw.shape[0], n_type, scale, raw.shape[1])
+    key = None if seed is None else (seed, sub, split, n_type, scale)
+    noise = plan_noise(plan, raw.shape[2], key=key)
+    noisy = apply_noise_plan(raw, plan, noise=noise)
+
+    # clean copies and labels keep the existing tiling
+    if n_type[0:4] == 'full':
+        n_clean, n_label = plan['n_blocks']+1, plan['n_blocks']+1
+    else:
+        n_clean, n_label = 3, 2
+    clean = np.tile(raw,(n_clean,1,1))
+    y = class_labels(np.tile(params[:,4],n_label))
 
     clean = clean[...,np.newaxis]
     noisy = noisy[...,np.newaxis]
+    if return_plan:
+        return noisy,clean,y,(plan,noise)
     return noisy,clean,y
 
+def noise_feats(raw, plan, noise=None, key=None, th=0.01, layout='flat', clean_feats=None):
+    # Features of apply_noise_plan(raw, plan) without building the noisy array. Features are per channel,
+    # so clean features are tiled once and only the corrupted channels of each segment are touched:
+    # flat channels have all-zero features and additive segments are re-extracted on their channels only.
+    if raw.shape[-1] == 1:
+        raw = raw[...,0]
+    # same rounding as extract_feats(apply_noise_plan(raw, plan)), quantized raw converts rows as they are read
+    if not isinstance(raw, QuantizedRaw):
+        raw = np.asarray(raw, dtype=DTYPE)
+    n, n_ch, win = raw.shape
+    if noise is None:
+        noise = plan_noise(plan, win, key=key)
+    if clean_feats is None:
+        clean_feats = extract_feats_par(raw, th, layout=layout)
+
+    out = feat_out((plan['n_blocks']+1)*n, n_ch, layout)
+    out.reshape((plan['n_blocks']+1, n) + out.shape[1:])[:] = clean_feats
+    feat = feat_view(out, out.shape[0], n_ch, layout)
+
+    for s in range(plan['op'].shape[0]):
+        start, stop = plan['start'][s], plan['stop'][s]
+        chs = np.nonzero(plan['mask'][s])[0]
+        if stop <= start or chs.shape[0] == 0:
+            continue
+        row = (plan['block'][s]+1)*n
+        if plan['op'][s] == NOISE_FLAT:
+            feat[row+start:row+stop,:,chs] = 0
+        else:
+            x = (raw[start:stop][:,chs,:] + noise[s,chs,:]).astype(DTYPE)
+            feat[row+start:row+stop,:,chs] = extract_feats(x, th).reshape(stop-start, 4, chs.shape[0])
+    return out
+
+class AugmentedView:
+    # Lazy view of add_noise output: holds the clean array, the noise plan and its (small) noise table and
+    # generates (noisy, clean, label) rows on demand, so memory stays near the clean data size.
+    # Row r pairs with clean row r % n; labels are class indices.
+    def __init__(self, raw, params, sub, n_type='flat', scale=5, seed=None, split='train'):
+        if not isinstance(raw, QuantizedRaw):
+            raw = np.asarray(raw, dtype=DTYPE)
+        if raw.shape[-1] == 1:
+            raw = raw[...,0]
+        n = raw.shape[0]
+        self.raw = raw
+        self.labels = params[:,4] - 1
+        self.plan = noise_plan(n, n_type, scale, raw.shape[1])
+        key = None if seed is None else (seed, sub, split, n_type, scale)
+        self.noise = plan_noise(self.plan, raw.shape[2], key=key)
+
+        # segment covering every row, -1 where the row is clean
+        self.seg = np.full((self.plan['n_blocks']+1)*n, -1, dtype=np.int32)
+        for s in range(self.plan['op'].shape[0]):
+            row = (self.plan['block'][s]+1)*n
+            self.seg[row+self.plan['start'][s]:row+self.plan['stop'][s]] = s
+
+    def __len__(self):
+        return self.seg.shape[0]
+
+    def rows(self, ind):
+        if isinstance(ind, slice):
+            return np.arange(*ind.indices(len(self)))
+        return np.arange(len(self))[ind]
+
+    def __getitem__(self, ind):
+        rows = np.atleast_1d(self.rows(ind))
+        src = rows % self.raw.shape[0]
+        clean = np.asarray(self.raw[src], dtype=DTYPE)
+        noisy = clean.copy()
+
+        seg = self.seg[rows]
+        ch_mask = self.plan['mask'][seg] & (seg >= 0)[:,np.newaxis]
+        op = self.plan['op'][seg]
+        noisy[ch_mask & (op == NOISE_FLAT)[:,np.newaxis]] = 0
+        add = ch_mask & (op != NOISE_FLAT)[:,np.newaxis]
+        np.add(noisy, self.noise[seg], out=noisy, where=add[...,np.newaxis])
+
+        return noisy[...,np.newaxis], clean[...,np.newaxis], self.labels[src]
+
+    def chunks(self, size=1024):
+        for start in range(0, len(self), size):
+            yield self[start:start+size]
+
+    def feats(self, th=0.01, layout='flat', clean=False):
+        # features of the noisy (or clean) rows, only corrupted channels are recomputed
+        clean_feats = extract_feats_par(self.raw, th, layout=layout)
+        if clean:
+            return np.tile(clean_feats, (self.plan['n_blocks']+1,) + (1,)*(clean_feats.ndim-1))
+        return noise_feats(self.raw, self.plan, self.noise, th=th, layout=layout, clean_feats=clean_feats)
+
+    def predict(self, model, transform=None, chunk=1024):
+        # model.predict on the noisy rows chunk by chunk, transform maps raw chunks to model inputs
+        out = []
+        for noisy, _, _ in self.chunks(chunk):
+            out.append(model.predict(noisy if transform is None else transform(noisy)))
+        if isinstance(out[0], (list, tuple)):
+            return [np.concatenate(o) for o in zip(*out)]
+        return np.concatenate(out)
+
 def add_noise_old(raw, params, sub, n_type='flat', scale=5):
     # Index subject and training group
     max_ch = raw.shape[1] + 1
@@ -379,7 +988,7 @@ def add_noise_old(raw, params, sub, n_type='flat', scale=5):
 
             out = np.concatenate((out,temp))
 
-    noisy, clean, y = out, orig, to_categorical(sub_params[:,-2]-1)
+    noisy, clean, y = out, orig, class_labels(sub_params[:,-2])
     # x, x2, y = out,orig,to_categorical(sub_params[:,-2]-1)
     # Add dimension to x data to fit CNN architecture
     # x = x[...,np.newaxis]
@@ -415,31 +1024,371 @@ def extract_feats_fast(raw):
     feat_out = np.concatenate([mav,zc,ssc,wl],-1)
     return feat_out
 
-def extract_feats(raw,th=0.01):
+def feat_out(samp, n_ch, layout='flat', dtype=None):
+    # flat: (samp, 4*ch) as [mav, zc, ssc, wl] blocks, ch: (samp, ch, 4) as used by the CNNs
+    dtype = DTYPE if dtype is None else dtype
+    if layout == 'flat':
+        return np.empty((samp, 4*n_ch), dtype=dtype)
+    elif layout == 'ch':
+        return np.empty((samp, n_ch, 4), dtype=dtype)
+    raise ValueError('unknown feature layout: ' + str(layout))
+
+def feat_view(out, samp, n_ch, layout='flat'):
+    # view of out indexed as (samp, feat, ch) regardless of layout
+    if layout == 'flat':
+        if out.shape != (samp, 4*n_ch):
+            raise ValueError('out must have shape ' + str((samp, 4*n_ch)))
+        return out.reshape(samp, 4, n_ch)
+    elif layout == 'ch':
+        if out.shape[:3] != (samp, n_ch, 4) or out.size != samp*n_ch*4:
+            raise ValueError('out must have shape ' + str((samp, n_ch, 4)))
+        return np.moveaxis(out.reshape(samp, n_ch, 4), 2, 1)
+    raise ValueError('unknown feature layout: ' + str(layout))
+
+def flat_to_ch(feat):
+    # flat (samp, 4*ch) features in the channel-major (samp, ch, 4) layout, as a contiguous copy
+    return np.ascontiguousarray(np.moveaxis(feat.reshape(feat.shape[0], 4, -1), 1, 2))
+
+def extract_feats(raw, th=0.01, out=None, layout='flat'):
     if raw.shape[-1] == 1:
-        raw = np.squeeze(raw)
-    N=raw.shape[2]
-    samp = raw.shape[0]
+        raw = raw[...,0]
+    samp, n_ch, N = raw.shape
 
-    mav=np.sum(np.absolute(raw),axis=2)/N
+    if out is None:
+        out = feat_out(samp, n_ch, layout)
+    feat = feat_view(out, samp, n_ch, layout)
 
-    last = np.roll(raw, 1, axis=2)
-    next = np.roll(raw, -1, axis=2)
+    # mean absolute value, mav and wl are accumulated in float64 whatever the out dtype, as in FeatStream
+    np.divide(np.sum(np.absolute(raw), axis=2, dtype=np.float64), N, out=feat[:,0,:])
 
-    # zero crossings
-    zero_change = (next[...,:-1]*raw[...,:-1] < 0) & (np.absolute(next[...,:-1]-raw[...,:-1])>th)
-    zc = np.sum(zero_change, axis=2)
+    # single first difference pass, reused by ssc, wl and zc
+    diff = np.diff(raw, axis=2)
+    rise = diff > 0
+    fall = diff < 0
 
     # slope sign change
-    next_s = next[...,1:-1] - raw[...,1:-1]
-    last_s = raw[...,1:-1] - last[...,1:-1]
-    sign_change = ((next_s > 0) & (last_s < 0)) | ((next_s < 0) & (last_s > 0))
-    th_check = (np.absolute(next_s) > th) & (np.absolute(last_s) > th)
-    ssc = np.sum(sign_change & th_check, axis=2)
+    sign_change = (rise[...,1:] & fall[...,:-1]) | (fall[...,1:] & rise[...,:-1])
+    np.absolute(diff, out=diff)
+    th_check = diff > th
+    sign_change &= th_check[...,1:]
+    sign_change &= th_check[...,:-1]
+    feat[:,2,:] = np.count_nonzero(sign_change, axis=2)
 
     # waveform length
-    wl = np.sum(np.absolute(next[...,:-1] - raw[...,:-1]), axis=2)
+    feat[:,3,:] = np.sum(diff, axis=2, dtype=np.float64)
 
-    # feat_out = 0
-    feat_out = np.concatenate([mav,zc,ssc,wl],-1)
-    return feat_out
\ No newline at end of file
+    # zero crossings, reusing the difference buffer for the sign product
+    np.multiply(raw[...,:-1], raw[...,1:], out=diff)
+    np.less(diff, 0, out=rise)
+    rise &= th_check
+    feat[:,1,:] = np.count_nonzero(rise, axis=2)
+
+    return out
+
+def extract_feats_par(raw, th=0.01, out=None, layout='flat', n_jobs=None, chunk=256):
+    # extract_feats over chunks of the sample axis on a thread pool, all writing into one out array
+    # numpy releases the GIL in the ufuncs, and temporaries are bounded by the chunk size
+    samp, n_ch = raw.shape[0], raw.shape[1]
+    if out is None:
+        out = feat_out(samp, n_ch, layout)
+    feat_view(out, samp, n_ch, layout)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    starts = range(0, samp, chunk)
+
+    def run(start):
+        extract_feats(raw[start:start+chunk], th, out=out[start:start+chunk], layout=layout)
+
+    if n_jobs == 1 or len(starts) <= 1:
+        for start in starts:
+            run(start)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(run, starts))
+    return out
+
+def raw_input(x, step=2, div=5, out=None, antialias=False, chunk=4096):
+    # network input for feat_type='raw': x[:,:,::step]/div as (n, ch, ceil(win/step), 1) in DTYPE, written
+    # straight into out in one pass. antialias low-pass filters before decimating (polyphase, resample_poly)
+    if x.shape[-1] == 1:
+        x = x[...,0]
+    n, n_ch, win = x.shape
+    if out is None:
+        out = np.empty((n, n_ch, -(-win // step), 1), dtype=DTYPE)
+    if antialias:
+        from scipy.signal import resample_poly
+
+    # chunks bound the filter's temporaries and let quantized raw convert as it is read
+    for start in range(0, n, chunk):
+        rows = x[start:start+chunk]
+        rows = resample_poly(rows, 1, step, axis=-1) if antialias else rows[...,::step]
+        np.divide(rows, div, out=out[start:start+chunk,...,0])
+    return out
+
+def count_above(amp, th_sorted):
+    # per row, number of terms along the last axis strictly above each sorted threshold
+    n_th = th_sorted.shape[0]
+    rows = amp.shape[:-1]
+    n_rows = int(np.prod(rows))
+
+    # bucket k holds terms above exactly k thresholds, -inf terms land in bucket 0
+    bucket = np.searchsorted(th_sorted, amp, side='left').reshape(n_rows, -1)
+    bucket += (n_th+1)*np.arange(n_rows)[:,np.newaxis]
+    hist = np.bincount(bucket.ravel(), minlength=n_rows*(n_th+1)).reshape(n_rows, n_th+1)
+
+    # terms in bucket k exceed thresholds 0..k-1
+    counts = np.cumsum(hist[:,::-1], axis=1)[:,::-1][:,1:]
+    return counts.reshape(rows + (n_th,))
+
+def extract_zc_ssc(raw, th):
+    # zc and ssc for every threshold in th from one pass, each returned as (samp, ch, n_th)
+    if raw.shape[-1] == 1:
+        raw = raw[...,0]
+    th = np.asarray(th, dtype=np.float64).ravel()
+    order = np.argsort(th)
+
+    diff = np.diff(raw, axis=2)
+    amp = np.absolute(diff)
+
+    # amplitude each term has to exceed to be counted, -inf where there is no crossing
+    zc_amp = np.where(raw[...,:-1]*raw[...,1:] < 0, amp, -np.inf)
+    sign_change = ((diff[...,1:] > 0) & (diff[...,:-1] < 0)) | ((diff[...,1:] < 0) & (diff[...,:-1] > 0))
+    ssc_amp = np.where(sign_change, np.minimum(amp[...,1:], amp[...,:-1]), -np.inf)
+
+    zc = np.empty(raw.shape[:2] + th.shape, dtype=np.int64)
+    ssc = np.empty(raw.shape[:2] + th.shape, dtype=np.int64)
+    zc[...,order] = count_above(zc_amp, th[order])
+    ssc[...,order] = count_above(ssc_amp, th[order])
+    return zc, ssc
+
+def cumsum0(x, dtype=None):
+    # cumulative sum along the last axis with a leading zero, so sum(x[a:b]) = cs[b] - cs[a]
+    out = np.zeros(x.shape[:-1] + (x.shape[-1]+1,), dtype=x.dtype if dtype is None else dtype)
+    np.cumsum(x, axis=-1, out=out[...,1:])
+    return out
+
+def extract_feats_dense(sig, win=200, hop=1, th=0.01, layout='flat'):
+    # sig: continuous (samples, ch) recording, features for windows starting at 0, hop, 2*hop, ...
+    # win can be a list of window lengths, all computed from the same prefix sums
+    # prefix sums stay float64 whatever DTYPE is, float32 would lose the window sums on long recordings
+    sig = np.asarray(sig, dtype=np.float64).T
+    n_ch, T = sig.shape
+
+    diff = np.diff(sig, axis=1)
+    th_check = np.absolute(diff) > th
+    sign_change = ((diff[:,1:] > 0) & (diff[:,:-1] < 0)) | ((diff[:,1:] < 0) & (diff[:,:-1] > 0))
+
+    # prefix sums of the per-sample terms, counts stay integer so zc/ssc are exact
+    abs_cs = cumsum0(np.absolute(sig))
+    wl_cs = cumsum0(np.absolute(diff))
+    zc_cs = cumsum0((sig[:,:-1]*sig[:,1:] < 0) & th_check, dtype=np.int64)
+    ssc_cs = cumsum0(sign_change & th_check[:,1:] & th_check[:,:-1], dtype=np.int64)
+
+    out = []
+    for w in np.atleast_1d(win):
+        start = np.arange(0, T-w+1, hop)
+        feat_all = feat_out(start.shape[0], n_ch, layout)
+        feat = feat_view(feat_all, start.shape[0], n_ch, layout)
+        feat[:,0,:] = (abs_cs[:,start+w] - abs_cs[:,start]).T / w
+        feat[:,1,:] = (zc_cs[:,start+w-1] - zc_cs[:,start]).T
+        feat[:,2,:] = (ssc_cs[:,start+w-2] - ssc_cs[:,start]).T
+        feat[:,3,:] = (wl_cs[:,start+w-1] - wl_cs[:,start]).T
+        out.append(feat_all)
+
+    if np.ndim(win) == 0:
+        return out[0]
+    return out
+
+def process_daq_dense(daq, sub, grp, win=200, hop=1, th=0.01, layout='flat'):
+    # dense features for one continuous (subject, group) recording of the daq cell array
+    return extract_feats_dense(daq[sub-1,0][0,grp-1], win, hop, th, layout)
+
+class FeatStream:
+    # Incremental mav/zc/ssc/wl over a sliding window, updated in O(1) per sample.
+    # The float sums are resynchronised from the ring buffer every time it wraps,
+    # so windows aligned to win samples match extract_feats exactly. The ring keeps the
+    # samples' float dtype and the sums are float64, the same arithmetic as extract_feats.
+    def __init__(self, n_ch=6, win=200, th=0.01):
+        if win < 3:
+            raise ValueError('win must be at least 3 samples')
+        self.n_ch = n_ch
+        self.win = win
+        self.th = th
+        self.buf = np.zeros((n_ch, win))
+        self.reset()
+
+    def reset(self):
+        self.buf[:] = 0
+        self.pos = 0
+        self.count = 0
+        self.abs_sum = np.zeros(self.n_ch)
+        self.wl = np.zeros(self.n_ch)
+        self.zc = np.zeros(self.n_ch, dtype=int)
+        self.ssc = np.zeros(self.n_ch, dtype=int)
+
+    @property
+    def ready(self):
+        return self.count == self.win
+
+    def zc_term(self, a, b):
+        return (a*b < 0) & (np.absolute(b - a) > self.th)
+
+    def ssc_term(self, a, b, c):
+        next_s = c - b
+        last_s = b - a
+        sign_change = ((next_s > 0) & (last_s < 0)) | ((next_s < 0) & (last_s > 0))
+        return sign_change & (np.absolute(next_s) > self.th) & (np.absolute(last_s) > self.th)
+
+    def push(self, x):
+        x = np.asarray(x)
+        if self.count == 0:
+            dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+            if self.buf.dtype != dtype:
+                self.buf = np.zeros((self.n_ch, self.win), dtype=dtype)
+        buf, win, pos = self.buf, self.win, self.pos
+
+        # drop the oldest sample and every term that starts at it
+        if self.count == win:
+            x0, x1, x2 = buf[:,pos], buf[:,(pos+1) % win], buf[:,(pos+2) % win]
+            self.abs_sum -= np.absolute(x0)
+            self.wl -= np.absolute(x1 - x0)
+            self.zc -= self.zc_term(x0, x1)
+            self.ssc -= self.ssc_term(x0, x1, x2)
+
+        # add the terms ending at the new sample
+        if self.count >= 1:
+            last = buf[:,(pos-1) % win]
+            self.wl += np.absolute(x - last)
+            self.zc += self.zc_term(last, x)
+            if self.count >= 2:
+                self.ssc += self.ssc_term(buf[:,(pos-2) % win], last, x)
+        self.abs_sum += np.absolute(x)
+
+        buf[:,pos] = x
+        self.pos = (pos + 1) % win
+        self.count = min(self.count + 1, win)
+
+        # ring is in time order again, recompute float sums to remove drift
+        if self.pos == 0 and self.ready:
+            self.abs_sum = np.sum(np.absolute(buf), axis=1, dtype=np.float64)
+            self.wl = np.sum(np.absolute(np.diff(buf, axis=1)), axis=1, dtype=np.float64)
+
+    def feats(self, layout='flat'):
+        out = np.concatenate([self.abs_sum/self.win, self.zc, self.ssc, self.wl]).astype(DTYPE)
+        if layout == 'ch':
+            out = out.reshape(4, self.n_ch).T
+        return out
+
+    def update(self, samples, layout='flat'):
+        # samples: (n, ch), returns one feature vector per sample once the window is full
+        samples = np.atleast_2d(samples)
+        out = []
+        for x in samples:
+            self.push(x)
+            if self.ready:
+                out.append(self.feats(layout))
+        if not out:
+            return np.zeros((0,) + self.feats(layout).shape)
+        return np.stack(out)
+
+class FeatCache:
+    # LRU cache of extracted features keyed by a content hash of the raw data and the feature parameters.
+    # With a folder, entries evicted from memory (and any left at flush) spill to disk, where the oldest
+    # files are removed once the folder passes max_disk_bytes, so later runs can skip featurisation
+    def __init__(self, max_bytes=2**30, folder=None, max_disk_bytes=2**32):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        self.store = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if folder is not None and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def key(self, raw, th=0.01):
+        raw = np.ascontiguousarray(raw)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str((raw.shape, raw.dtype.str, float(th), np.dtype(DTYPE).str)).encode())
+        h.update(memoryview(raw).cast('B'))
+        return h.hexdigest()
+
+    def filename(self, key):
+        return self.folder + '/' + key + '.npy'
+
+    def disk_files(self):
+        # cached .npy files, oldest first
+        files = [f for f in os.scandir(self.folder) if f.name.endswith('.npy')]
+        return sorted(files, key=lambda f: f.stat().st_mtime)
+
+    def spill(self, key, feat):
+        if self.folder is None or os.path.isfile(self.filename(key)):
+            return
+        np.save(self.filename(key), feat)
+        files = self.disk_files()
+        disk_bytes = sum(f.stat().st_size for f in files)
+        for f in files:
+            if disk_bytes <= self.max_disk_bytes:
+                break
+            disk_bytes -= f.stat().st_size
+            os.remove(f.path)
+
+    def put(self, key, feat):
+        feat.setflags(write=False)
+        self.store[key] = feat
+        self.nbytes += feat.nbytes
+        while self.nbytes > self.max_bytes and len(self.store) > 1:
+            old_key, old = self.store.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.spill(old_key, old)
+
+    def get(self, key):
+        if key in self.store:
+            self.hits += 1
+            self.store.move_to_end(key)
+            return self.store[key]
+        if self.folder is not None and os.path.isfile(self.filename(key)):
+            self.hits += 1
+            self.disk_hits += 1
+            # refresh the file's age so the disk copy is evicted least recently used
+            os.utime(self.filename(key))
+            feat = np.load(self.filename(key))
+            self.put(key, feat)
+            return feat
+        return None
+
+    def extract(self, raw, th=0.01, layout='flat'):
+        # returned arrays are shared with the cache and read-only
+        if raw.shape[-1] == 1:
+            raw = raw[...,0]
+        key = self.key(raw, th)
+
+        feat = self.get(key + '_' + layout)
+        if feat is None:
+            self.misses += 1
+            # the channel-major layout is only a transpose of cached flat features
+            flat = self.get(key + '_flat') if layout == 'ch' else None
+            if flat is None:
+                feat = extract_feats_par(raw, th, layout=layout)
+            else:
+                feat = flat_to_ch(flat)
+            self.put(key + '_' + layout, feat)
+        return feat
+
+    def stats(self):
+        disk_bytes = 0 if self.folder is None else sum(f.stat().st_size for f in self.disk_files())
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'entries': len(self.store), 'nbytes': self.nbytes, 'disk_bytes': disk_bytes}
+
+    def flush(self):
+        # write the entries still in memory to disk, e.g. at the end of a run
+        for key, feat in self.store.items():
+            self.spill(key, feat)
+
+    def clear(self, disk=False):
+        self.store.clear()
+        self.nbytes = 0
+        if disk and self.folder is not None:
+            for f in self.disk_files():
+                os.remove(f.path)
@@ -5,8 +5,8 @@ import numpy as np
 from tensorflow.keras.layers import Lambda, Input, Dense, Conv2D, Flatten, Conv2DTranspose, Reshape, concatenate, BatchNormalization, MaxPooling2D
 from tensorflow.keras.models import Model
 from tensorflow.keras.datasets import mnist
-from tensorflow.keras.losses import mse, binary_crossentropy, categorical_crossentropy
-from tensorflow.keras.utils import plot_model, to_categorical
+from tensorflow.keras.losses import mse, binary_crossentropy, sparse_categorical_crossentropy
+from tensorflow.keras.utils import plot_model
 from tensorflow.keras import backend as K
 from tensorflow.keras import regularizers
 
@@ -76,7 +76,7 @@ def build_svae(latent_dim, n_class, input_type='feat', sparse='True'):
         vae_loss = K.mean((reconstruction_loss + kl_loss)/100.0)
         return vae_loss
 
-    vae.compile(optimizer='adam', loss=[VAE_loss,'categorical_crossentropy'],experimental_run_tf_function=False,metrics=['accuracy'])
+    vae.compile(optimizer='adam', loss=[VAE_loss,'sparse_categorical_crossentropy'],experimental_run_tf_function=False,metrics=['accuracy'])
     return vae, encoder, decoder, clf_supervised
 
 ## VARIATIONAL LATENT SPACE CLASSIFIER - NO DECODER
@@ -122,7 +122,7 @@ def build_vcnn(latent_dim, n_class, input_type='feat',sparse='True'):
         # x_origin=K.flatten(x_origin)
         # x_out=K.flatten(x_out)
         # xent_loss = input_shape[0]*input_shape[1] * binary_crossentropy(x_origin, x_out)
-        class_loss = input_shape[0]*input_shape[1]*categorical_crossentropy(x_origin, x_out)
+        class_loss = input_shape[0]*input_shape[1]*sparse_categorical_crossentropy(x_origin, x_out)
         kl_loss = 1 + z_log_var - K.square(z_mean) - K.exp(z_log_var)
         kl_loss = K.sum(kl_loss, axis=-1)
         kl_loss *= -0.5
@@ -165,7 +165,7 @@ def build_cnn(latent_dim, n_class, input_type='feat',sparse='True'):
     outputs = clf_supervised(encoder(inputs))
     vae = Model(inputs, outputs, name='vae_mlp')
 
-    vae.compile(optimizer='adam', loss='categorical_crossentropy',experimental_run_tf_function=False,metrics=['accuracy'])
+    vae.compile(optimizer='adam', loss='sparse_categorical_crossentropy',experimental_run_tf_function=False,metrics=['accuracy'])
     return vae, encoder, clf_supervised
 
 def build_cnn_old(latent_dim, n_class, input_type='feat',sparse='True'):
@@ -192,7 +192,7 @@ def build_cnn_old(latent_dim, n_class, input_type='feat',sparse='True'):
     outputs = clf_supervised(encoder(inputs))
     vae = Model(inputs, outputs, name='vae_mlp')
 
-    vae.compile(optimizer='adam', loss='categorical_crossentropy',experimental_run_tf_function=False,metrics=['accuracy'])
+    vae.compile(optimizer='adam', loss='sparse_categorical_crossentropy',experimental_run_tf_function=False,metrics=['accuracy'])
     return vae, encoder, clf_supervised
 
 ## LATENT SPACE CLASSIFIER - NO DECODER
@@ -227,7 +227,7 @@ def build_sae(latent_dim, n_class, input_type='feat', sparse='True'):
     outputs = clf_supervised(encoder(inputs))
     vae = Model(inputs, outputs, name='vae_mlp')
 
-    vae.compile(optimizer='adam', loss='categorical_crossentropy',experimental_run_tf_function=False,metrics=['accuracy'])
+    vae.compile(optimizer='adam', loss='sparse_categorical_crossentropy',experimental_run_tf_function=False,metrics=['accuracy'])
     return vae, encoder, clf_supervised
 
 ## VARIATIONAL AUTOENCODER - NO CLASSIFIER
@@ -280,12 +280,19 @@ def build_vae(latent_dim, input_type='feat'):
     vae.compile(optimizer='adam', loss=VAE_loss, experimental_run_tf_function=False)
     return vae, encoder, decoder
 
+def class_index(y):
+    # labels are integer class columns, one-hot rows from older callers are still accepted
+    y = np.asarray(y)
+    if y.ndim > 1 and y.shape[1] > 1:
+        return np.argmax(y, axis=1)
+    return y.reshape(-1)
+
 def eval_vae(vae, x_test, y_test):
     try:
         y_pred = np.argmax(vae.predict(x=x_test)[1], axis=1)
     except:
         y_pred = np.argmax(vae.predict(x=x_test), axis=1)
-    acc = np.sum(np.argmax(y_test, axis=1) == y_pred)/y_pred.shape[0]
+    acc = np.sum(class_index(y_test) == y_pred)/y_pred.shape[0]
     return y_pred, acc
 
 def recon_vae(vae, x_test):
@@ -343,7 +350,7 @@ def build_vae_old(latent_dim, input_type='feat'):
     kl_loss *= -0.5
     vae_loss = K.mean((reconstruction_loss + kl_loss)/100.0)
     vae.add_loss(vae_loss)
-    vae.compile(optimizer='adam', loss={'clf': 'categorical_crossentropy'})
+    vae.compile(optimizer='adam', loss={'clf': 'sparse_categorical_crossentropy'})
     return vae, encoder, decoder, clf_supervised
 
 ## NOT SURE WHAT THIS IS
@@ -403,12 +410,12 @@ def build_vae_s(latent_dim, input_type='feat'):
     kl_loss *= -0.5
     vae_loss = K.mean((reconstruction_loss + kl_loss)/100.0)
     vae.add_loss(vae_loss)
-    vae.compile(optimizer='adam', loss={'clf': 'categorical_crossentropy'})
+    vae.compile(optimizer='adam', loss={'clf': 'sparse_categorical_crossentropy'})
     return vae, encoder1, encoder, decoder, clf_supervised
 
 def eval_vae_s(enc, clf, x_test, y_test):
     y_pred = np.argmax(clf.predict(enc.predict)[1], axis=1)
-    acc = np.sum(np.argmax(y_test, axis=1) == y_pred)/y_pred.shape[0]
+    acc = np.sum(class_index(y_test) == y_pred)/y_pred.shape[0]
     return y_pred, acc
 
 ## OLD TRANSFER LEARNING STUFF
@@ -465,7 +472,7 @@ def build_pnn(source_weights, latent_dim, input_type='feat'):
     kl_loss *= -0.5
     vae_loss = K.mean((reconstruction_loss + kl_loss)/100.0)
     vae.add_loss(vae_loss)
-    vae.compile(optimizer='adam', loss={'clf': 'categorical_crossentropy'})
+    vae.compile(optimizer='adam', loss={'clf': 'sparse_categorical_crossentropy'})
     
     vae.set_weights(source_weights)
     # Freeze model
@@ -514,7 +521,7 @@ def build_pnn(source_weights, latent_dim, input_type='feat'):
     kl_loss *= -0.5
     vae_loss = K.mean((reconstruction_loss + kl_loss)/100.0)
     t_vae.add_loss(vae_loss)
-    t_vae.compile(optimizer='adam', loss={'t_clf': 'categorical_crossentropy'})
+    t_vae.compile(optimizer='adam', loss={'t_clf': 'sparse_categorical_crossentropy'})
 
     plot_model(t_vae, to_file='pnn.png', show_shapes=True)
 